@@ -0,0 +1,227 @@
+"""
+Module: earthquake_benchmark
+
+Benchmarks for the earthquake clustering pipeline in earthquake_clusters.
+
+Synthetic catalogs (uniform, Gaussian blobs and dense aftershock sequences)
+are written as USGS style CSV files, and each stage of the pipeline is timed
+at several sizes. Every dbscan engine is checked against the labels of the
+reference dbscan. The python and partitioned engines take time that grows
+with the number of neighbour pairs, which is quadratic on dense catalogs, so
+they (and the label check) only run on catalogs up to --max-reference-size.
+
+Example:
+    python earthquake_benchmark.py --sizes 1000 10000 --memory
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import earthquake_clusters as eq
+
+def clip_to_map(points):
+    """
+    Returns the (n, 2) array of (longitude, latitude) points with the
+    longitudes wrapped into -180..180 and the latitudes clipped to -90..90.
+    """
+    points[:, 0] = (points[:, 0] + 180) % 360 - 180
+    points[:, 1] = np.clip(points[:, 1], -90, 90)
+    return points
+
+def uniform_catalog(n, rng):
+    """
+    Returns n earthquakes spread evenly over the map.
+    """
+    return np.column_stack([rng.uniform(-180, 180, n), rng.uniform(-90, 90, n)])
+
+def blob_catalog(n, rng, num_blobs=50):
+    """
+    Returns n earthquakes in Gaussian blobs of different widths
+    scattered over the map.
+    """
+    centres = np.column_stack([rng.uniform(-180, 180, num_blobs), rng.uniform(-60, 60, num_blobs)])
+    spreads = rng.uniform(0.5, 3.0, num_blobs)
+    blob = rng.integers(num_blobs, size=n)
+    return clip_to_map(centres[blob] + rng.normal(size=(n, 2)) * spreads[blob, None])
+
+def aftershock_catalog(n, rng, num_mainshocks=20):
+    """
+    Returns n earthquakes where nine in ten are aftershocks packed densely
+    around a few mainshocks, with their distance from the mainshock falling
+    off like a power law. The rest are spread evenly over the map.
+    """
+    num_background = n // 10
+    num_aftershocks = n - num_background
+    mainshocks = np.column_stack([rng.uniform(-180, 180, num_mainshocks), rng.uniform(-60, 60, num_mainshocks)])
+    # Bigger sequences for the first mainshocks, like real catalogs.
+    weights = 1.0 / np.arange(1, num_mainshocks + 1)
+    mainshock = rng.choice(num_mainshocks, size=num_aftershocks, p=weights / weights.sum())
+    distances = np.minimum(0.02 * rng.pareto(1.2, num_aftershocks), 5.0)
+    angles = rng.uniform(0, 2 * np.pi, num_aftershocks)
+    offsets = np.column_stack([distances * np.cos(angles), distances * np.sin(angles)])
+    aftershocks = clip_to_map(mainshocks[mainshock] + offsets)
+    return np.concatenate([aftershocks, uniform_catalog(num_background, rng)])
+
+CATALOGS = {
+    "uniform": uniform_catalog,
+    "blobs": blob_catalog,
+    "aftershocks": aftershock_catalog,
+}
+
+#The default epsilon of each metric, about half a degree either way.
+DEFAULT_EPSILON = {"euclidean": 0.5, "haversine": 55.0}
+
+#The engines whose time grows with the number of neighbour pairs.
+PAIR_ENGINES = ["python", "partitioned"]
+
+def write_catalog(locations, filename):
+    """
+    Writes the (n, 2) array of (longitude, latitude) locations as a USGS
+    style CSV file, including a quoted place name with a comma in it.
+    """
+    np.savetxt(filename, locations[:, ::-1], delimiter=",", comments="",
+               header="time,latitude,longitude,depth,mag,place",
+               fmt='2021-10-01T00:00:00.000Z,%.4f,%.4f,10.0,2.5,"Somewhere, Earth"')
+
+def run_stage(results, name, memory, func, *args):
+    """
+    Runs func(*args), appends (name, seconds, peak bytes) to results and
+    returns what func returned. The peak memory is only measured (with
+    tracemalloc, which also slows the stage down) if memory is True.
+    """
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    value = func(*args)
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    results.append((name, seconds, peak))
+    return value
+
+def run_engine(engine, data, epsilon, min_pts, metric, processes):
+    """
+    Clusters the data store data with the named dbscan engine
+    and returns the number of clusters.
+    """
+    if engine == "python":
+        return eq.dbscan(data, epsilon, min_pts, metric)
+    elif engine == "numpy":
+        labels = eq.dbscan_numpy(data.to_array(), epsilon, min_pts, metric)
+        data.set_labels(labels)
+        return int(labels.max()) + 1 if len(labels) > 0 else 0
+    elif engine == "partitioned":
+        return eq.dbscan_partitioned(data, epsilon, min_pts, metric, processes=processes)
+    else:
+        raise ValueError("Unknown dbscan engine: %s" % engine)
+
+def plot_on_canvas(clusters, data):
+    """
+    Plots the clusters on an off-screen figure and draws it.
+    """
+    figure = Figure(figsize=(20.48, 10.24), dpi=100)
+    canvas = FigureCanvasAgg(figure)
+    eq.plot_clusters(clusters, data, figure.add_axes([0, 0, 1, 1]))
+    canvas.draw()
+
+def benchmark_catalog(filename, engines, epsilon, min_pts, metric, processes, memory, check, max_reference_size):
+    """
+    Runs every stage of the pipeline on the CSV file filename. Returns a
+    list of (stage, seconds, peak bytes) tuples, a dictionary that maps
+    each engine other than "python" that ran to True if its labels matched
+    the reference dbscan (None when not checked), and the list of engines
+    skipped because the catalog has more than max_reference_size points.
+    """
+    results = []
+    locations = run_stage(results, "get_eq_locations", memory, eq.get_eq_locations, filename)
+    data = run_stage(results, "initialize_database", memory, eq.initialize_database, locations)
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    skipped = []
+    if len(locations) > max_reference_size:
+        skipped = [engine for engine in engines if engine in PAIR_ENGINES]
+        check = False
+
+    # The reference labels come from the python engine, run first.
+    reference = None
+    count = None
+    if check or ("python" in engines and "python" not in skipped):
+        count = run_stage(results, "dbscan[python]", memory, run_engine,
+                          "python", data, epsilon, min_pts, metric, processes)
+        reference = list(data.labels)
+    matches = {}
+    for engine in engines:
+        if engine == "python" or engine in skipped:
+            continue
+        data = eq.initialize_database(locations)
+        count = run_stage(results, "dbscan[%s]" % engine, memory, run_engine,
+                          engine, data, epsilon, min_pts, metric, processes)
+        matches[engine] = list(data.labels) == reference if check else None
+    if count is None:
+        return results, matches, skipped
+
+    clusters = run_stage(results, "get_clusters", memory, eq.get_clusters, data, count)
+    run_stage(results, "plot_clusters", memory, plot_on_canvas, clusters, data)
+    return results, matches, skipped
+
+def main(argv):
+    """
+    Command line entry point that prints a table of the time and peak
+    memory of each stage for every catalog and size.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the earthquake clustering pipeline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--catalogs", nargs="+", choices=sorted(CATALOGS), default=sorted(CATALOGS))
+    parser.add_argument("--engines", nargs="+", choices=["python", "numpy", "partitioned"],
+                        default=["python", "numpy", "partitioned"])
+    parser.add_argument("--metric", choices=["euclidean", "haversine"], default="euclidean")
+    parser.add_argument("--epsilon", type=float, default=None,
+                        help="degrees, or kilometres for haversine (default %s)" %
+                             " or ".join("%s for %s" % (value, metric) for metric, value in DEFAULT_EPSILON.items()))
+    parser.add_argument("--min-pts", type=int, default=4)
+    parser.add_argument("--processes", type=int, default=None, help="processes for the partitioned engine")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--memory", action="store_true", help="measure peak memory (slows stages down)")
+    parser.add_argument("--no-check", action="store_true", help="skip comparing labels with dbscan")
+    parser.add_argument("--max-reference-size", type=int, default=10000,
+                        help="largest catalog the python and partitioned engines and the label check run on")
+    args = parser.parse_args(argv)
+    epsilon = DEFAULT_EPSILON[args.metric] if args.epsilon is None else args.epsilon
+
+    rng = np.random.default_rng(args.seed)
+    failed = False
+    print("%-12s %9s  %-22s %10s %10s" % ("catalog", "size", "stage", "seconds", "peak MB"))
+    with tempfile.TemporaryDirectory() as folder:
+        for catalog in args.catalogs:
+            for size in args.sizes:
+                filename = os.path.join(folder, "%s_%d.csv" % (catalog, size))
+                write_catalog(CATALOGS[catalog](size, rng), filename)
+                results, matches, skipped = benchmark_catalog(filename, args.engines, epsilon, args.min_pts,
+                                                              args.metric, args.processes, args.memory,
+                                                              not args.no_check, args.max_reference_size)
+                for stage, seconds, peak in results:
+                    peak_text = "-" if peak is None else "%.1f" % (peak / 1e6)
+                    print("%-12s %9d  %-22s %10.3f %10s" % (catalog, size, stage, seconds, peak_text))
+                for engine, same in matches.items():
+                    if same is not None:
+                        print("%-12s %9d  labels[%s] %s" % (catalog, size, engine,
+                                                            "match dbscan" if same else "DIFFER from dbscan"))
+                        failed = failed or not same
+                for engine in skipped:
+                    print("%-12s %9d  dbscan[%s] skipped above %d points" % (catalog, size, engine,
+                                                                           args.max_reference_size))
+                if skipped and not args.no_check:
+                    print("%-12s %9d  labels not checked above %d points" % (catalog, size,
+                                                                            args.max_reference_size))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -8,11 +8,92 @@ Authors:
 2) Eric Pan - epan@sandiego.edu
 """
 
+import os
 import sys
+import csv
+import glob
 import math
+import bisect
+import itertools
+import argparse
+import multiprocessing
+import concurrent.futures
+from array import array
+from collections import deque
+import numpy as np
 import matplotlib.pyplot as pp
+import matplotlib.colors as colors
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import imageio
 
+# Mean radius of the earth, used by the haversine metric.
+EARTH_RADIUS_KM = 6371.0
+
+# Label of a point that dbscan has not looked at yet.
+UNVISITED = -2
+
+# First bytes of a binary catalog cache file (see load_eq_array), followed
+# by the source file size, its modification time and the number of rows.
+CACHE_MAGIC = b"EQCACHE1"
+CACHE_HEADER_SIZE = 32
+
+class PointStore:
+    """
+    Stores the earthquake locations and their cluster labels in parallel
+    columns, with one row for each earthquake. Two earthquakes at the same
+    location are kept as separate rows.
+    """
+
+    def __init__(self):
+        """
+        Creates an empty store. The following instance variables are
+        initialized:
+        lons - array of the longitude of each row.
+        lats - array of the latitude of each row.
+        labels - int32 array of the cluster number of each row, -1 for
+            outliers, or UNVISITED before dbscan has looked at the row.
+        """
+        self.lons = array('d')
+        self.lats = array('d')
+        self.labels = array('i')
+
+    def __len__(self):
+        """
+        Returns the number of rows.
+        """
+        return len(self.lons)
+
+    def append(self, point):
+        """
+        Adds the (longitude, latitude) point as a new, unvisited row.
+        """
+        self.lons.append(point[0])
+        self.lats.append(point[1])
+        self.labels.append(UNVISITED)
+
+    def point(self, row):
+        """
+        Returns the (longitude, latitude) of the point in row.
+        """
+        return (self.lons[row], self.lats[row])
+
+    def to_array(self):
+        """
+        Returns the locations as an (n, 2) numpy array.
+        """
+        locations = np.empty((len(self), 2))
+        locations[:, 0] = self.lons
+        locations[:, 1] = self.lats
+        return locations
+
+    def set_labels(self, labels):
+        """
+        Replaces the labels with the integer array labels,
+        like the one returned by dbscan_numpy.
+        """
+        self.labels = array('i', np.asarray(labels, dtype=np.int32).tobytes())
+
 def euclidean_distance(point1, point2):
     """
     Returns the euclidean distance between point1 and point2.
@@ -22,170 +103,1285 @@ def euclidean_distance(point1, point2):
     # Uses the x and y values of the points
     return math.sqrt((point2[0] - point1[0]) ** 2 + (point2[1] - point1[1]) ** 2)
 
-def get_close_points(p, epsilon, data):
+def haversine_distance(point1, point2):
+    """
+    Returns the great-circle distance in kilometres between point1 and point2.
+    point1 and point2 are (longitude, latitude) tuples in degrees.
+    """
+    # Uses the haversine formula on a sphere with the mean radius of the earth.
+    lon1, lat1 = math.radians(point1[0]), math.radians(point1[1])
+    lon2, lat2 = math.radians(point2[0]), math.radians(point2[1])
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+def get_distance_function(metric):
+    """
+    Returns the distance function for metric, which is either "euclidean"
+    (epsilon in degrees) or "haversine" (epsilon in kilometres).
+    """
+    if metric == "euclidean":
+        return euclidean_distance
+    elif metric == "haversine":
+        return haversine_distance
+    else:
+        raise ValueError("Unknown distance metric: %s" % metric)
+
+def get_unit_vector(p):
+    """
+    Returns the (x, y, z) point on the unit sphere for the
+    (longitude, latitude) point p.
+    """
+    lon, lat = math.radians(p[0]), math.radians(p[1])
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+def get_unit_vectors(locations):
+    """
+    Returns an (n, 3) array of the points on the unit sphere for the
+    (n, 2) array of (longitude, latitude) locations, like get_unit_vector.
     """
-    Returns a list of all the points in the dataset data 
-    that are the within epsilon of p.
+    lons, lats = np.radians(locations[:, 0]), np.radians(locations[:, 1])
+    return np.column_stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)])
+
+def get_chord_length(epsilon):
+    """
+    Returns the straight-line distance through the unit sphere between
+    two points that are epsilon kilometres apart along the surface.
+    It is made very slightly longer so rounding never loses a neighbour.
+    """
+    angle = min(epsilon / EARTH_RADIUS_KM, math.pi)
+    return 2 * math.sin(angle / 2) * (1 + 1e-9)
+
+def get_grid_cell(p, epsilon, metric="euclidean"):
+    """
+    Returns the grid cell containing point p when the plane is divided
+    into square cells whose sides are epsilon long.
+    For the haversine metric the points are placed on the unit sphere and
+    the cells are cubes whose sides are the chord length of epsilon, which
+    works the same way near the poles and across the antimeridian.
+    """
+    if metric == "haversine":
+        size = get_chord_length(epsilon)
+        return tuple(math.floor(coord / size) for coord in get_unit_vector(p))
+    return (math.floor(p[0] / epsilon), math.floor(p[1] / epsilon))
+
+def build_grid_index(data, epsilon, metric="euclidean"):
+    """
+    Returns a dictionary that maps each grid cell to a list of the rows
+    of the points in data that fall in that cell. Any point within epsilon
+    of p lies either in p's cell or in one of the cells around it.
+    """
+    index = {}
+    for row, point in enumerate(zip(data.lons, data.lats)):
+        cell = get_grid_cell(point, epsilon, metric)
+        if cell not in index:
+            index[cell] = [row]
+        else:
+            index[cell].append(row)
+    return index
+
+def get_close_points(p, epsilon, data, index=None, metric="euclidean"):
+    """
+    Returns a list of the rows of all the points in the dataset data 
+    that are the within epsilon of the point in row p.
+    If index (from build_grid_index) is given, only the points in the
+    cells around p are checked instead of the whole dataset.
+    metric is "euclidean" or "haversine" (see get_distance_function).
 	"""
 
     # Initializes a list and iterates through the dataset. 
     # Checks to see if the point in the dataset is within the boundary.
     # of the point p and if so add the point to the list.
     points_list = []
+    distance = get_distance_function(metric)
+    lons, lats = data.lons, data.lats
+    point = (lons[p], lats[p])
 
-    for key in data.keys():
-        if key == p:
-            continue
-        if euclidean_distance(key, p) < epsilon:
-            points_list.append(key)
+    if index is None:
+        candidates = [range(len(data))]
+    else:
+        # Only the block of cells around p (3x3, or 3x3x3 on the sphere)
+        # can hold points within epsilon.
+        cell = get_grid_cell(point, epsilon, metric)
+        candidates = [index.get(tuple(c + d for c, d in zip(cell, offset)), ())
+                      for offset in itertools.product((-1, 0, 1), repeat=len(cell))]
+
+    for cell in candidates:
+        for row in cell:
+            if row == p:
+                continue
+            if distance((lons[row], lats[row]), point) < epsilon:
+                points_list.append(row)
     return points_list
 
-def add_to_cluster(points, cluster_num, data, epsilon, min_pts):
+def add_to_cluster(points, cluster_num, data, epsilon, min_pts, index=None, metric="euclidean"):
     """
-    Does not return anything but adds a list of points to the
-    desired cluster. Uses the get_close_points method and
-    add_to_cluster recursively.
+    Does not return anything but adds a list of rows to the
+    desired cluster. Uses the get_close_points method and a queue
+    of points to expand, so large clusters never hit the recursion limit.
+    index and metric are passed on to get_close_points.
     """
+    # Points that were just added to the cluster and still need their
+    # neighbourhood checked. Each point is queued at most once, because it
+    # is labelled with cluster_num as soon as it is queued.
+    frontier = deque()
+    labels = data.labels
     # Iterate through a list of points.
     # Points within epsilon of each other should be added to cluster_num.
-    for p in points:
-        if data[p] == None or data[p] == -1:
-            data[p] = cluster_num
-            close_points = get_close_points(p, epsilon, data)
-            # Checks to see if there are a minimum number of points within epsiolon of point p.
-            # If so, call add_to_cluster recursively until there are no more points to be added.
-            if len(close_points) >= min_pts:
-                add_to_cluster(close_points, cluster_num, data, epsilon, min_pts)
-
-def dbscan(data, epsilon, min_pts):
-    """
-    Iterates through the data dictionary and creates a new cluster,
+    while True:
+        for p in points:
+            if labels[p] == UNVISITED:
+                labels[p] = cluster_num
+                frontier.append(p)
+            elif labels[p] == -1:
+                # Outliers already had fewer than min_pts close points, so they
+                # join the cluster as edge points without another search.
+                labels[p] = cluster_num
+        if not frontier:
+            break
+        p = frontier.popleft()
+        close_points = get_close_points(p, epsilon, data, index, metric)
+        # Checks to see if there are a minimum number of points within epsiolon of point p.
+        # If not, p is an edge point and its neighbours are not added.
+        if len(close_points) >= min_pts:
+            points = close_points
+        else:
+            points = ()
+
+def dbscan(data, epsilon, min_pts, metric="euclidean"):
+    """
+    Iterates through the rows of the data store and creates a new cluster,
     adding new points to the cluster and identifying outliers.
     Uses get_close_points and add_to_cluster.
+    metric is "euclidean" (epsilon in degrees) or "haversine"
+    (epsilon in kilometres).
     """
-    # Set the cluster number to 0 and iterate through the data in the dictionary.
+    # Build the grid index once so neighbour queries only look at nearby cells.
+    index = build_grid_index(data, epsilon, metric)
+    # Set the cluster number to 0 and iterate through the rows of the data.
     cluster_num = 0
-    for key in data.keys():
+    labels = data.labels
+    for row in range(len(data)):
         # Check to see if the data has not been assigned to a cluster number yet.
-        if data[key] == None:
-            close_points = get_close_points(key, epsilon, data)
+        if labels[row] == UNVISITED:
+            close_points = get_close_points(row, epsilon, data, index, metric)
             # Check to see if the point has enough points around it so that the point
             # can be considered as part of a cluster or an outlier.
             if len(close_points) < min_pts:
-                data[key] = -1
+                labels[row] = -1
             else:
-                data[key] = cluster_num
-                add_to_cluster(close_points, cluster_num, data, epsilon, min_pts)
+                labels[row] = cluster_num
+                add_to_cluster(close_points, cluster_num, data, epsilon, min_pts, index, metric)
                 # Increase the cluster number for each new cluster.
                 cluster_num += 1
     # Return the total number of clusters in the data.
     return cluster_num
 
+def get_haversine_distances(lon1, lat1, lon2, lat2):
+    """
+    Returns the great-circle distances in kilometres between numpy arrays
+    of longitudes and latitudes in degrees, computed like haversine_distance.
+    The arrays are broadcast against each other.
+    """
+    lon1, lat1 = np.radians(lon1), np.radians(lat1)
+    lon2, lat2 = np.radians(lon2), np.radians(lat2)
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+def get_search_coords(locations, epsilon, metric="euclidean"):
+    """
+    Returns the coordinates the numpy neighbour search works on and a width
+    such that two points within epsilon are always less than width apart
+    in a straight line. These are the (n, 2) array locations and epsilon
+    themselves, or on the sphere the unit vectors and the chord length.
+    """
+    if metric == "haversine":
+        return get_unit_vectors(locations), get_chord_length(epsilon)
+    elif metric == "euclidean":
+        return locations, epsilon
+    else:
+        raise ValueError("Unknown distance metric: %s" % metric)
+
+def get_close_pairs(locations, coords, rows, cols, epsilon, width, metric="euclidean"):
+    """
+    Returns a boolean array that is True where the points in rows and cols
+    (indexes into locations and coords, see get_search_coords) are within
+    epsilon of each other, computed the same way as get_close_points.
+    """
+    diff = coords[cols] - coords[rows]
+    if metric == "euclidean":
+        dx, dy = diff[:, 0], diff[:, 1]
+        return np.sqrt(dx * dx + dy * dy) < epsilon
+    # Only pairs whose chord is short enough can be close,
+    # so the haversine formula is only used on those.
+    close = (diff * diff).sum(axis=1) < width * width
+    first = locations[rows[close]]
+    second = locations[cols[close]]
+    close[close] = get_haversine_distances(first[:, 0], first[:, 1], second[:, 0], second[:, 1]) < epsilon
+    return close
+
+def group_by_cell(point_cells, mask, num_cells):
+    """
+    Returns (members, starts, sizes) for the points where mask is True,
+    given the cell number of every point in point_cells. The points of
+    cell c are members[starts[c]:starts[c] + sizes[c]].
+    """
+    members = np.flatnonzero(mask)
+    members = members[np.argsort(point_cells[members], kind="stable")]
+    sizes = np.bincount(point_cells[members], minlength=num_cells)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    return members, starts, sizes
+
+def iter_cell_pair_points(cells, other_cells, group, other_group, chunk_size):
+    """
+    Yields (pairs, rows, cols) arrays that pair every point of group (see
+    group_by_cell) in cells[i] with every point of other_group in
+    other_cells[i], where pairs holds i. About chunk_size point pairs are
+    yielded at a time, so the pairs are never all in memory at once.
+    """
+    members, starts, sizes = group
+    other_members, other_starts, other_sizes = other_group
+    counts = sizes[cells] * other_sizes[other_cells]
+    ends = np.cumsum(counts)
+    first = 0
+    while first < len(cells):
+        done = ends[first - 1] if first > 0 else 0
+        last = max(first + 1, int(np.searchsorted(ends, done + chunk_size, side="right")))
+        chunk_counts = counts[first:last]
+        pairs = np.repeat(np.arange(first, last), chunk_counts)
+        if len(pairs) > 0:
+            local = np.arange(len(pairs)) - np.repeat(ends[first:last] - chunk_counts - done, chunk_counts)
+            widths = other_sizes[other_cells[pairs]]
+            rows = members[starts[cells[pairs]] + local // widths]
+            cols = other_members[other_starts[other_cells[pairs]] + local % widths]
+            yield pairs, rows, cols
+        first = last
+
+def get_components(num_nodes, src, dst):
+    """
+    Returns an array giving each of num_nodes nodes the smallest node it is
+    joined to by the edges (src, dst), found by repeatedly pointing every
+    group at the smallest node in it.
+    """
+    src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+    parent = np.arange(num_nodes)
+    while True:
+        src_root = parent[src]
+        dst_root = parent[dst]
+        if np.array_equal(src_root, dst_root):
+            break
+        np.minimum.at(parent, src_root, dst_root)
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    return parent
+
+class CellGrid:
+    """
+    The points of an (n, 2) array of locations sorted into a grid of cells
+    small enough that the points in one cell are always within epsilon of
+    each other. dbscan_numpy clusters with it, and sweep_parameters keeps
+    one for each epsilon so the neighbour counts are shared by every min_pts.
+    Only chunk_size point pairs are compared at once and the pairs are never
+    stored, so memory does not grow with the number of neighbours.
+    """
+
+    def __init__(self, locations, epsilon, metric="euclidean", chunk_size=1 << 19):
+        """
+        Sorts the points into cells. The following instance variables are
+        initialized:
+        locations, coords, width - the points, and the coordinates and width
+            the search works on (see get_search_coords).
+        point_cells - array of the cell number of each point.
+        num_cells - the number of cells with points in them.
+        offsets - the code differences from a cell to the cells around it.
+        everyone - every point grouped by cell (see group_by_cell).
+        """
+        self.locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+        self.epsilon = epsilon
+        self.metric = metric
+        self.chunk_size = chunk_size
+        self.coords, self.width = get_search_coords(self.locations, epsilon, metric)
+        num_points = len(self.locations)
+        self.cell_codes = np.zeros(0, dtype=np.int64)
+        self.point_cells = np.zeros(0, dtype=np.intp)
+        self.offsets = []
+        if num_points > 0:
+            # The cells have a diagonal just under width, so a neighbour is never
+            # more than two cells away along any axis. Each cell gets a code from
+            # its position so the cells next to it can be found with a search.
+            dims = self.coords.shape[1]
+            side = self.width / math.sqrt(dims) * (1 - 1e-6)
+            cells = np.floor(self.coords / side).astype(np.int64)
+            cells -= cells.min(axis=0) - 2
+            spans = cells.max(axis=0) + 3
+            if np.prod(spans.astype(float)) >= 2.0 ** 62:
+                raise ValueError("epsilon is too small for the area the points cover")
+            strides = np.cumprod(np.concatenate([[1], spans[:-1]]))
+            self.cell_codes, self.point_cells = np.unique(cells @ strides, return_inverse=True)
+            self.point_cells = self.point_cells.ravel()
+            self.offsets = [int(np.dot(offset, strides)) for offset in itertools.product(range(-2, 3), repeat=dims)]
+        self.num_cells = len(self.cell_codes)
+        self.everyone = group_by_cell(self.point_cells, np.ones(num_points, dtype=bool), self.num_cells)
+
+    def get_cell_pairs(self, offset):
+        """
+        Returns arrays (cells, other_cells) of every pair of cells
+        where the second is offset from the first.
+        """
+        targets = self.cell_codes + offset
+        found = np.minimum(np.searchsorted(self.cell_codes, targets), self.num_cells - 1)
+        cells = np.flatnonzero(self.cell_codes[found] == targets)
+        return cells, found[cells]
+
+    def is_close(self, rows, cols):
+        """
+        Returns a boolean array that is True where the points
+        rows[i] and cols[i] are within epsilon of each other.
+        """
+        return get_close_pairs(self.locations, self.coords, rows, cols, self.epsilon, self.width, self.metric)
+
+    def iter_close_pairs(self, offsets, group, other_group):
+        """
+        Yields (pairs, rows, cols) like iter_cell_pair_points for the pairs of
+        cells at each of offsets, keeping only the points that are close.
+        """
+        for offset in offsets:
+            cells, other_cells = self.get_cell_pairs(offset)
+            for pairs, rows, cols in iter_cell_pair_points(cells, other_cells, group, other_group, self.chunk_size):
+                close = self.is_close(rows, cols)
+                yield pairs[close], rows[close], cols[close]
+
+    def count_neighbours(self, max_min_pts):
+        """
+        Returns an array with the number of neighbours of each point, or at
+        least max_min_pts for points that have that many. The other points
+        in a point's cell are all neighbours, so only points in cells of
+        max_min_pts points or fewer count the close points around them.
+        """
+        cell_sizes = np.bincount(self.point_cells, minlength=self.num_cells)
+        counts = cell_sizes[self.point_cells] - 1
+        sparse = group_by_cell(self.point_cells, cell_sizes[self.point_cells] <= max_min_pts, self.num_cells)
+        for pairs, rows, cols in self.iter_close_pairs([offset for offset in self.offsets if offset != 0],
+                                                       sparse, self.everyone):
+            counts += np.bincount(rows, minlength=len(counts))
+        return counts
+
+    def get_labels(self, core, block_size=4096):
+        """
+        Returns the dbscan labels of the points given the boolean array core
+        of the core points. Two cells with more than block_size pairs of core
+        points are compared a piece at a time, stopping at the first close pair.
+        """
+        num_points = len(self.locations)
+        labels = np.full(num_points, -1, dtype=np.int32)
+
+        # The core points of a cell are all in one cluster. Join two cells
+        # (each pair once) when any of their core points are close.
+        cores = group_by_cell(self.point_cells, core, self.num_cells)
+        core_sizes = cores[2]
+        src, dst, big_cells, big_others = [], [], [], []
+        for offset in self.offsets:
+            if offset <= 0:
+                continue
+            cells, other_cells = self.get_cell_pairs(offset)
+            both = (core_sizes[cells] > 0) & (core_sizes[other_cells] > 0)
+            cells, other_cells = cells[both], other_cells[both]
+            small = core_sizes[cells] * core_sizes[other_cells] <= block_size
+            big_cells.append(cells[~small])
+            big_others.append(other_cells[~small])
+            cells, other_cells = cells[small], other_cells[small]
+            for pairs, rows, cols in iter_cell_pair_points(cells, other_cells, cores, cores, self.chunk_size):
+                joined = np.unique(pairs[self.is_close(rows, cols)])
+                src.append(cells[joined])
+                dst.append(other_cells[joined])
+        parent = get_components(self.num_cells, np.concatenate(src + [np.zeros(0, dtype=np.intp)]),
+                                np.concatenate(dst + [np.zeros(0, dtype=np.intp)])).tolist()
+        for cell, other in zip(np.concatenate(big_cells + [np.zeros(0, dtype=np.intp)]).tolist(),
+                               np.concatenate(big_others + [np.zeros(0, dtype=np.intp)]).tolist()):
+            root, other_root = find_root(parent, cell), find_root(parent, other)
+            if root == other_root:
+                continue
+            members = cores[0][cores[1][cell]:cores[1][cell] + core_sizes[cell]]
+            other_members = cores[0][cores[1][other]:cores[1][other] + core_sizes[other]]
+            step = max(1, self.chunk_size // len(other_members))
+            for start in range(0, len(members), step):
+                rows = np.repeat(members[start:start + step], len(other_members))
+                cols = np.tile(other_members, len(members[start:start + step]))
+                if self.is_close(rows, cols).any():
+                    parent[max(root, other_root)] = min(root, other_root)
+                    break
+        roots = np.array(parent, dtype=np.intp)
+        while True:
+            grandparent = roots[roots]
+            if np.array_equal(grandparent, roots):
+                break
+            roots = grandparent
+
+        # dbscan numbers the clusters in the order it first reaches a core
+        # point, which is the order of the smallest core index in each cluster.
+        core_rows = np.flatnonzero(core)
+        cluster_roots, first, inverse = np.unique(roots[self.point_cells[core_rows]],
+                                                  return_index=True, return_inverse=True)
+        cluster_nums = np.empty(len(cluster_roots), dtype=np.int32)
+        cluster_nums[np.argsort(first)] = np.arange(len(cluster_roots))
+        labels[core_rows] = cluster_nums[inverse.ravel()]
+
+        # An edge point joins the first cluster (lowest number) that reaches it.
+        num_clusters = len(cluster_roots)
+        edge_labels = np.full(num_points, num_clusters, dtype=np.int32)
+        others = group_by_cell(self.point_cells, ~core, self.num_cells)
+        for pairs, rows, cols in self.iter_close_pairs(self.offsets, others, cores):
+            np.minimum.at(edge_labels, rows, labels[cols])
+        reached = edge_labels < num_clusters
+        labels[reached] = edge_labels[reached]
+        return labels
+
+def dbscan_numpy(locations, epsilon, min_pts, metric="euclidean", chunk_size=1 << 19, block_size=4096):
+    """
+    Returns an integer array with the cluster number of each row in the
+    (n, 2) array locations, or -1 for outliers. Gives the same labels as
+    dbscan on a data store built from the same points in the same order,
+    but works on a CellGrid with vectorized numpy operations: a crowded
+    cell is all core points without measuring a distance, and two cells
+    join their clusters as soon as one pair of their core points is close.
+    chunk_size and block_size are as for CellGrid and CellGrid.get_labels.
+    metric is "euclidean" or "haversine", as for dbscan.
+    """
+    grid = CellGrid(locations, epsilon, metric, chunk_size)
+    return grid.get_labels(grid.count_neighbours(min_pts) >= min_pts, block_size)
+
+def get_k_distances(locations, k, metric="euclidean"):
+    """
+    Returns an array with the distance from each row of the (n, 2) array
+    locations to its k-th nearest other point (infinity if there are not
+    k other points). A point is a core point for dbscan with min_pts = k
+    exactly when this distance is below epsilon.
+    The neighbours are found with a KD-tree from scipy.
+    """
+    from scipy.spatial import cKDTree
+
+    locations = np.asarray(locations, dtype=float).reshape(-1, 2)
+    if len(locations) == 0:
+        return np.zeros(0)
+    # On the sphere the tree holds unit vectors. The straight-line distance
+    # between them grows with the great-circle distance, so the nearest
+    # neighbours are the same and the distance converts back exactly.
+    if metric == "haversine":
+        coords = get_unit_vectors(locations)
+    else:
+        get_distance_function(metric)
+        coords = locations
+    # The closest point found is the point itself, so ask for one more.
+    distances, _ = cKDTree(coords).query(coords, k=[k + 1])
+    distances = distances[:, 0]
+    if metric == "haversine":
+        finite = np.isfinite(distances)
+        distances[finite] = 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, distances[finite] / 2))
+    return distances
+
+def suggest_epsilon(k_distances):
+    """
+    Returns an epsilon taken from the knee of the sorted k-distance curve
+    (see get_k_distances): the point of the curve farthest below the
+    straight line joining its two ends, once both axes are scaled to 0..1.
+    Points to the right of the knee are the sparse ones that become outliers.
+    """
+    curve = np.sort(np.asarray(k_distances, dtype=float))
+    curve = curve[np.isfinite(curve)]
+    if len(curve) == 0:
+        raise ValueError("No point has enough neighbours to suggest an epsilon")
+    if curve[-1] == curve[0]:
+        return float(curve[0])
+    x = np.linspace(0.0, 1.0, len(curve))
+    y = (curve - curve[0]) / (curve[-1] - curve[0])
+    return float(curve[np.argmax(x - y)])
+
+def sweep_parameters(locations, epsilons, min_pts_values, metric="euclidean"):
+    """
+    Clusters the (n, 2) array locations like dbscan_numpy for every pair
+    of epsilon in epsilons and min_pts in min_pts_values.
+    The grid and the neighbour counts are made once for each epsilon and
+    shared by all the min_pts values, which only change the core points.
+    Returns a list of (epsilon, min_pts, number of clusters, number of
+    outliers) tuples, in order of increasing epsilon.
+    """
+    results = []
+    for epsilon in sorted(epsilons):
+        grid = CellGrid(locations, epsilon, metric)
+        counts = grid.count_neighbours(max(min_pts_values, default=0))
+        for min_pts in min_pts_values:
+            labels = grid.get_labels(counts >= min_pts)
+            num_clusters = int(labels.max()) + 1 if len(labels) > 0 else 0
+            results.append((epsilon, min_pts, num_clusters, int(np.count_nonzero(labels == -1))))
+    return results
+
+def find_root(parent, x):
+    """
+    Returns the root of x in the union-find dictionary parent,
+    shortening the path to it along the way.
+    """
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+def union(parent, x, y):
+    """
+    Joins the groups of x and y in the union-find dictionary parent.
+    """
+    parent.setdefault(x, x)
+    parent.setdefault(y, y)
+    root_x, root_y = find_root(parent, x), find_root(parent, y)
+    if root_x != root_y:
+        parent[max(root_x, root_y)] = min(root_x, root_y)
+
+def cluster_tile(task):
+    """
+    Clusters one tile for dbscan_partitioned. task holds the owned points,
+    the halo points around them (two epsilons wide), epsilon, min_pts and
+    the metric, with every point given as (row number, point).
+    Returns the row numbers of the owned core points, (row, root) links
+    joining core points that are close to each other, and for each owned
+    point that is not a core point the roots of its core neighbours.
+    """
+    owned, halo, epsilon, min_pts, metric = task
+    # The tile gets its own data store; rows maps its rows back to the
+    # rows of the whole dataset. The owned points come first.
+    tile = initialize_database(point for _, point in owned + halo)
+    rows = [row for row, _ in owned + halo]
+    index = build_grid_index(tile, epsilon, metric)
+    close = {}
+    for local in range(len(owned)):
+        close[local] = get_close_points(local, epsilon, tile, index, metric)
+    # Points in the halo that touch an owned point are within epsilon of the
+    # tile, so their whole neighbourhood is inside the halo as well.
+    for local in set(itertools.chain.from_iterable(close.values())) - close.keys():
+        close[local] = get_close_points(local, epsilon, tile, index, metric)
+
+    parent = {}
+    owned_cores = []
+    edge_roots = []
+    for local in range(len(owned)):
+        if len(close[local]) >= min_pts:
+            owned_cores.append(rows[local])
+            union(parent, local, local)
+            for other in close[local]:
+                if len(close[other]) >= min_pts:
+                    union(parent, local, other)
+    for local in range(len(owned)):
+        if len(close[local]) < min_pts:
+            # A core neighbour in the halo may not be linked to anything in
+            # this tile; its own tile links it, so its row is used instead.
+            roots = {rows[find_root(parent, other)] if other in parent else rows[other]
+                     for other in close[local] if len(close[other]) >= min_pts}
+            if roots:
+                edge_roots.append((rows[local], list(roots)))
+    links = [(rows[local], rows[find_root(parent, local)]) for local in parent]
+    return owned_cores, links, edge_roots
+
+def get_tile_cuts(values, count):
+    """
+    Returns count - 1 sorted values that split values into count
+    groups of about the same size, or no values if values is empty.
+    """
+    values = sorted(values)
+    if len(values) == 0:
+        return []
+    return [values[len(values) * i // count] for i in range(1, count)]
+
+def dbscan_partitioned(data, epsilon, min_pts, metric="euclidean", processes=None, tiles=None):
+    """
+    Does the same as dbscan, giving exactly the same labels, but splits the
+    points into tiles that are clustered in parallel by a pool of processes.
+    Each tile also gets the points in a halo two epsilons wide around it, so
+    every point next to the tile has all of its neighbours. The clusters
+    of the tiles are then joined across the tile borders.
+    processes defaults to the number of CPUs and tiles to twice that.
+    Returns the total number of clusters in the data.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if tiles is None:
+        tiles = 2 * processes
+    keys = list(zip(data.lons, data.lats))
+    if len(keys) == 0:
+        return 0
+
+    # Tiles are a grid cut at the longitude and latitude quantiles so each
+    # holds about the same number of points. On the sphere the tiles are
+    # latitude bands going all the way around, so no tile has to wrap.
+    if metric == "haversine":
+        columns = 1
+        halo = 2 * math.degrees(epsilon / EARTH_RADIUS_KM) * (1 + 1e-9)
+    else:
+        get_distance_function(metric)
+        columns = max(1, int(math.sqrt(tiles)))
+        halo = 2 * epsilon
+    bands = max(1, tiles // columns)
+    lon_cuts = get_tile_cuts([key[0] for key in keys], columns)
+    lat_cuts = get_tile_cuts([key[1] for key in keys], bands)
+
+    # Give each point to the tile it falls in and to the halo of every
+    # other tile that is within the halo width of it.
+    owned = {}
+    halos = {}
+    for row, key in enumerate(keys):
+        tile = (bisect.bisect_right(lon_cuts, key[0]), bisect.bisect_right(lat_cuts, key[1]))
+        owned.setdefault(tile, []).append((row, key))
+        if metric == "haversine":
+            lon_range = range(0, 1)
+        else:
+            lon_range = range(bisect.bisect_right(lon_cuts, key[0] - halo),
+                              bisect.bisect_right(lon_cuts, key[0] + halo) + 1)
+        lat_range = range(bisect.bisect_right(lat_cuts, key[1] - halo),
+                          bisect.bisect_right(lat_cuts, key[1] + halo) + 1)
+        for other in itertools.product(lon_range, lat_range):
+            if other != tile:
+                halos.setdefault(other, []).append((row, key))
+    tasks = [(points, halos.get(tile, []), epsilon, min_pts, metric) for tile, points in owned.items()]
+
+    pool = None
+    if processes == 1:
+        results = map(cluster_tile, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(cluster_tile, tasks)
+
+    # Join the clusters of all the tiles. The workers are stopped even if
+    # a tile fails, since the results are all in when the loop finishes.
+    is_core = [False] * len(keys)
+    parent = {}
+    edge_roots = []
+    try:
+        for owned_cores, links, tile_edges in results:
+            for row in owned_cores:
+                is_core[row] = True
+            for row, root in links:
+                union(parent, row, root)
+            edge_roots.extend(tile_edges)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    # Number the clusters and assign the edge points the way dbscan does:
+    # clusters in the order of their smallest core point, and each edge
+    # point to the lowest numbered cluster next to it.
+    labels = data.labels
+    cluster_nums = {}
+    for row in range(len(keys)):
+        labels[row] = -1
+        if is_core[row]:
+            root = find_root(parent, row)
+            if root not in cluster_nums:
+                cluster_nums[root] = len(cluster_nums)
+            labels[row] = cluster_nums[root]
+    for row, roots in edge_roots:
+        labels[row] = min(cluster_nums[find_root(parent, root)] for root in roots)
+    return len(cluster_nums)
+
+class IncrementalDBSCAN:
+    """
+    Keeps DBSCAN clusters up to date while earthquakes are inserted into
+    and expired from a live feed. Only the clusters next to a change are
+    relabelled, so a refresh costs about as much as the new events rather
+    than clustering the whole window again.
+    Cluster numbers are kept stable between updates, so they are not always
+    0 to num_clusters - 1. Core points are grouped exactly as dbscan groups
+    them; an edge point next to two clusters joins the lower numbered one.
+    """
+
+    def __init__(self, epsilon, min_pts, metric="euclidean"):
+        """
+        Creates an empty set of clusters for the given dbscan parameters.
+        The following instance variables are initialized:
+        points - maps an event id to its (longitude, latitude).
+        labels - maps an event id to its cluster number, or -1 for outliers.
+        neighbours - maps an event id to the set of event ids within epsilon.
+        members - maps a cluster number to the set of event ids in it.
+        index - maps a grid cell to the set of event ids in that cell.
+        """
+        self.epsilon = epsilon
+        self.min_pts = min_pts
+        self.metric = metric
+        self.distance = get_distance_function(metric)
+        self.points = {}
+        self.labels = {}
+        self.neighbours = {}
+        self.members = {}
+        self.index = {}
+        self.next_id = 0
+        self.next_cluster = 0
+
+    def num_clusters(self):
+        """
+        Returns the number of clusters.
+        """
+        return len(self.members)
+
+    def get_database(self):
+        """
+        Returns (data, num_clusters), where data is a data store of the
+        current points with the clusters numbered from 0, ready for
+        get_clusters and plot_clusters.
+        """
+        event_ids = list(self.points)
+        data = initialize_database(self.points[event_id] for event_id in event_ids)
+        numbers = {cluster_num: i for i, cluster_num in enumerate(self.members)}
+        numbers[-1] = -1
+        for row, event_id in enumerate(event_ids):
+            data.labels[row] = numbers[self.labels[event_id]]
+        return data, len(self.members)
+
+    def insert(self, point):
+        """
+        Adds the (longitude, latitude) point to the clusters and returns
+        its event id, which is used to expire it later.
+        """
+        point = tuple(point)
+        event_id = self.next_id
+        self.next_id += 1
+
+        # Find the neighbours of the new point and link them both ways.
+        cell = get_grid_cell(point, self.epsilon, self.metric)
+        close = set()
+        for offset in itertools.product((-1, 0, 1), repeat=len(cell)):
+            for other in self.index.get(tuple(c + d for c, d in zip(cell, offset)), ()):
+                if self.distance(self.points[other], point) < self.epsilon:
+                    close.add(other)
+        self.points[event_id] = point
+        self.labels[event_id] = -1
+        self.neighbours[event_id] = close
+        self.index.setdefault(cell, set()).add(event_id)
+
+        # The new point and any neighbour that just reached min_pts are the
+        # only new core points, and only they can grow or merge clusters.
+        new_cores = []
+        if self.is_core(event_id):
+            new_cores.append(event_id)
+        for other in close:
+            self.neighbours[other].add(event_id)
+            if len(self.neighbours[other]) == self.min_pts:
+                new_cores.append(other)
+        waiting = set(new_cores)
+        edge_points = set()
+        for core in new_cores:
+            waiting.discard(core)
+            edge_points |= self.add_core(core, waiting)
+        if not self.is_core(event_id):
+            edge_points.add(event_id)
+
+        # Edge points are placed once all the new core points are, so each
+        # one joins the lowest numbered cluster next to it.
+        for other in edge_points:
+            self.attach_edge_point(other)
+        return event_id
+
+    def expire(self, event_id):
+        """
+        Removes the point with the given event id from the clusters,
+        splitting any cluster that it was holding together.
+        """
+        affected = set()
+        if self.is_core(event_id):
+            affected.add(self.labels[event_id])
+        self.set_label(event_id, -1)
+        point = self.points.pop(event_id)
+        del self.labels[event_id]
+        cell = get_grid_cell(point, self.epsilon, self.metric)
+        self.index[cell].discard(event_id)
+        if not self.index[cell]:
+            del self.index[cell]
+
+        # Neighbours that drop below min_pts stop being core points, so
+        # their clusters may fall apart as well.
+        for other in self.neighbours.pop(event_id):
+            self.neighbours[other].discard(event_id)
+            if len(self.neighbours[other]) == self.min_pts - 1:
+                affected.add(self.labels[other])
+        for cluster_num in affected:
+            self.split_cluster(cluster_num)
+
+    def is_core(self, event_id):
+        """
+        Returns True if the point has at least min_pts neighbours.
+        """
+        return len(self.neighbours[event_id]) >= self.min_pts
+
+    def set_label(self, event_id, cluster_num):
+        """
+        Moves the point to cluster cluster_num (-1 for outliers),
+        keeping members up to date.
+        """
+        old = self.labels[event_id]
+        if old != -1:
+            self.members[old].discard(event_id)
+            if not self.members[old]:
+                del self.members[old]
+        if cluster_num != -1:
+            self.members.setdefault(cluster_num, set()).add(event_id)
+        self.labels[event_id] = cluster_num
+
+    def new_cluster_num(self):
+        """
+        Returns a cluster number that has not been used yet.
+        """
+        self.next_cluster += 1
+        return self.next_cluster - 1
+
+    def add_core(self, core, waiting):
+        """
+        Puts a new core point into a cluster, merging every cluster it
+        connects into the largest of them. Core points in waiting have
+        not been placed yet and are skipped; they connect when they are added.
+        Returns the set of points that are not core points and may now have
+        a different lowest numbered cluster next to them: the neighbours of
+        the new core point and of the core points of the merged clusters.
+        """
+        clusters = {self.labels[other] for other in self.neighbours[core]
+                    if other not in waiting and self.is_core(other)}
+        edge_points = set(self.neighbours[core])
+        if not clusters:
+            target = self.new_cluster_num()
+        else:
+            # Relabel the smaller clusters so a merge costs as little as possible.
+            target = max(clusters, key=lambda cluster_num: len(self.members[cluster_num]))
+            for cluster_num in clusters:
+                if cluster_num != target:
+                    for event_id in self.members[cluster_num]:
+                        self.labels[event_id] = target
+                        if self.is_core(event_id):
+                            edge_points |= self.neighbours[event_id]
+                    self.members[target] |= self.members.pop(cluster_num)
+        self.set_label(core, target)
+        return {event_id for event_id in edge_points if not self.is_core(event_id)}
+
+    def attach_edge_point(self, event_id):
+        """
+        Puts a point that is not a core point into the lowest numbered
+        cluster of its core neighbours, or marks it as an outlier.
+        """
+        clusters = [self.labels[other] for other in self.neighbours[event_id] if self.is_core(other)]
+        self.set_label(event_id, min(clusters) if clusters else -1)
+
+    def split_cluster(self, cluster_num):
+        """
+        Regroups the core points of a cluster that lost core points. The
+        largest group keeps cluster_num, the others get new numbers, and the
+        remaining points are attached to whichever cluster is next to them.
+        """
+        members = self.members.pop(cluster_num, set())
+        for event_id in members:
+            self.labels[event_id] = -1
+        cores = {event_id for event_id in members if self.is_core(event_id)}
+
+        # Split the core points into connected groups.
+        groups = []
+        unvisited = set(cores)
+        while unvisited:
+            start = unvisited.pop()
+            group = [start]
+            frontier = deque([start])
+            while frontier:
+                for other in self.neighbours[frontier.popleft()]:
+                    if other in unvisited:
+                        unvisited.discard(other)
+                        group.append(other)
+                        frontier.append(other)
+            groups.append(group)
+        groups.sort(key=len, reverse=True)
+        for i, group in enumerate(groups):
+            label = cluster_num if i == 0 else self.new_cluster_num()
+            for event_id in group:
+                self.set_label(event_id, label)
+
+        for event_id in members - cores:
+            self.attach_edge_point(event_id)
+
 def get_clusters(data, num_clusters):
     """
-    Returns a list of clusters where each element is a list of points in the cluster.
-    """
-    # Initialize a dictionary where the values are a list of points in their respective clusters.
-    id = {}
-    clusters = []
-    # Iterate through the data dictionary and check if the data points are assigned to a valid cluster number.
-    for key in data.keys():
-        if data[key] <= num_clusters-1 and data[key] != -1:
-            # If the value for the data point is not in the id dictionary yet, create a new key for the cluster
-            # number and create a value which is a new list for the points within the cluster. Otherwise, append
-            # the point to the list.
-            if data[key] not in id:
-                id[data[key]] = [key]
-            else:
-                id[data[key]].append(key)
-    # Create a list of clusters
-    clusters = [list(value) for value in id.values()]
-    return clusters
+    Returns a list of clusters, in order of cluster number, where each
+    element is an array of the rows of the points in the cluster.
+    """
+    # Sort the rows that are in a cluster by their cluster number in one
+    # pass, then cut the sorted rows wherever the cluster number changes.
+    labels = np.frombuffer(data.labels, dtype=np.int32)
+    rows = np.flatnonzero((labels >= 0) & (labels < num_clusters))
+    rows = rows[np.argsort(labels[rows], kind="stable")]
+    counts = np.bincount(labels[rows], minlength=num_clusters)
+    clusters = np.split(rows, np.cumsum(counts)[:-1])
+    return [cluster for cluster in clusters if len(cluster) > 0]
 
-def plot_clusters(clusters):
+def plot_clusters(clusters, data, axes=None):
     """
-    Plot clusters containing coordinate points using matplotlib.pyplot.
+    Plot clusters, given as lists of rows in the data store data, using matplotlib.pyplot.
+    If axes is given the clusters are drawn on it instead of the current pyplot figure.
     """
 
-    #Makes a list containing x coordinates and a list containing y coordinates.
-    for cluster in clusters:
-        x_coords = list()
-        y_coords = list()
-        for point in cluster:
-            x_coords.append(point[0])
-            y_coords.append(point[1])
-        #Plots the coordinate points
-        pp.scatter(x_coords, y_coords)
+    if not clusters:
+        return
+    #Draws every cluster with one scatter call. Each point gets the colour
+    #its cluster would get from separate scatter calls, which cycle through
+    #the default colours.
+    rows = np.concatenate(clusters)
+    colours = colors.to_rgba_array(pp.rcParams['axes.prop_cycle'].by_key()['color'])
+    colour_nums = np.arange(len(clusters)) % len(colours)
+    point_colours = colours[np.repeat(colour_nums, [len(cluster) for cluster in clusters])]
+    lons = np.frombuffer(data.lons, dtype=float)
+    lats = np.frombuffer(data.lats, dtype=float)
+    #Plots the coordinate points
+    if axes is None:
+        axes = pp
+    axes.scatter(lons[rows], lats[rows], c=point_colours)
+
+def iter_eq_locations(filename):
+    """
+    Yields the (longitude, latitude) of each earthquake in filename one row
+    at a time, so the file is never read into memory all at once.
+    Quoted fields that contain commas (like the USGS place names) are read
+    correctly, and the columns are found from the header row.
+    """
+
+    #Opens the file and reads it one row at a time.
+    with open(filename, 'r', newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            return
+        #Finds the longitude and latitude columns, using the USGS
+        #positions if the header does not name them.
+        header = [name.strip().lower() for name in header]
+        lon_col = header.index("longitude") if "longitude" in header else 2
+        lat_col = header.index("latitude") if "latitude" in header else 1
+        #Gets the longitude and latitude for each earthquake in the file
+        #in the format of (longitude, latitude).
+        for row in reader:
+            if row:
+                yield (float(row[lon_col]), float(row[lat_col]))
 
 def get_eq_locations(filename):
     """
     Gets earthquake location given by filename containing longitude and latitude for each earthquake. 
     """
 
-    #Opens and reads file.
-    file = open(filename, 'r')
-    lines = file.readlines()
-    eq_list = []
-    #Gets the longitude and latitude for each earthquake in the file
-    #in the format of (longitude, latitude).
-    for line in lines[1:]:
-        eq_split = line.split(",")
-        point = (float(eq_split[2]), float(eq_split[1]))
-        #All coordinate points of earthquake is added to a list.
-        eq_list.append(tuple(point))
-    return eq_list
+    #All coordinate points of earthquake are added to a list.
+    return list(iter_eq_locations(filename))
+
+def read_eq_array(filename):
+    """
+    Returns an (n, 2) numpy array with the (longitude, latitude) of each
+    earthquake in filename. The values are streamed straight into the
+    array without building a list of tuples first.
+    """
+    values = itertools.chain.from_iterable(iter_eq_locations(filename))
+    return np.fromiter(values, dtype=float).reshape(-1, 2)
+
+def write_cache_file(cache_name, write):
+    """
+    Calls write with a binary file open for writing and then moves the
+    file to cache_name. Writing to a temporary file first means runs in
+    parallel never read a half written cache. A folder we cannot write
+    to just means no cache.
+    """
+    temp_name = "%s.%d.tmp" % (cache_name, os.getpid())
+    try:
+        with open(temp_name, 'wb') as file:
+            write(file)
+        os.replace(temp_name, cache_name)
+    except OSError:
+        try:
+            os.remove(temp_name)
+        except OSError:
+            pass
+
+def load_eq_array(filename, use_cache=True):
+    """
+    Returns an (n, 2) array with the (longitude, latitude) of each
+    earthquake in filename, like read_eq_array. The parsed values are
+    cached in a binary file next to filename (filename + ".eqcache") with
+    the longitudes and then the latitudes stored as columns. Later calls
+    memory-map the cache instead of parsing the text again, as long as
+    the size and modification time of filename have not changed.
+    """
+    if not use_cache:
+        return read_eq_array(filename)
+    cache_name = filename + ".eqcache"
+    info = os.stat(filename)
+    try:
+        with open(cache_name, 'rb') as file:
+            header = file.read(CACHE_HEADER_SIZE)
+        if len(header) == CACHE_HEADER_SIZE and header.startswith(CACHE_MAGIC):
+            size, mtime_ns, rows = np.frombuffer(header, dtype='<i8', offset=len(CACHE_MAGIC)).tolist()
+            if size == info.st_size and mtime_ns == info.st_mtime_ns:
+                if rows == 0:
+                    return np.zeros((0, 2))
+                columns = np.memmap(cache_name, dtype='<f8', mode='r',
+                                    offset=CACHE_HEADER_SIZE, shape=(2, rows))
+                return columns.T
+    except (OSError, ValueError):
+        pass
+
+    locations = read_eq_array(filename)
+
+    def write(file):
+        file.write(CACHE_MAGIC)
+        file.write(np.array([info.st_size, info.st_mtime_ns, len(locations)], dtype='<i8').tobytes())
+        file.write(np.ascontiguousarray(locations.T, dtype='<f8').tobytes())
+    write_cache_file(cache_name, write)
+    return locations
 
 def initialize_database(locations):
     """
-    Creates the intial dataset by making a dictionary with the coordinate points as the key
-    and the value assigned as None.
+    Creates the intial dataset by making a data store with one row for each
+    coordinate point in locations, marked as UNVISITED. Repeated points are
+    kept as separate rows.
     """
-    database = {}
-    #Assigns None for each coordinate point as key.
+    database = PointStore()
+    #Copies the columns of an (n, 2) numpy array straight into the store.
+    if isinstance(locations, np.ndarray):
+        database.lons.frombytes(memoryview(np.ascontiguousarray(locations[:, 0], dtype=float)).cast('B'))
+        database.lats.frombytes(memoryview(np.ascontiguousarray(locations[:, 1], dtype=float)).cast('B'))
+        database.labels = array('i', [UNVISITED]) * len(database.lons)
+        return database
+    #Adds a row for each coordinate point.
     for point in locations:
-        database[tuple(point)] = None
+        database.append(point)
     return database
 
-def plot_earthquakes(filename):
+def cluster_earthquakes(filename, engine="python", metric="euclidean", epsilon=None, min_pts=4, use_cache=True):
+    """
+    Creates clusters of earthquakes from the data contained in filename.
+    Returns the data store and the number of clusters.
+    engine chooses how the clusters are made: "python" uses dbscan and
+    "numpy" uses dbscan_numpy.
+    metric is "euclidean" (flat longitude/latitude) or "haversine"
+    (great-circle distance in kilometres).
+    epsilon defaults to 2 degrees (220 km for haversine). If it is "auto"
+    it is picked from the knee of the k-distance curve for min_pts.
+    If use_cache is True the parsed file is cached (see load_eq_array),
+    otherwise it is streamed from the text every time.
+    """
+
+    # Step 1: Gets a list of all of the earthquake locations.
+    # Step 2: Initializes the data store.
+    # Step 3: Use dbscan to create clusters.
+    if use_cache:
+        eq_locations = load_eq_array(filename)
+    else:
+        eq_locations = iter_eq_locations(filename)
+    eq_data = initialize_database(eq_locations)
+    if epsilon is None:
+        if metric == "haversine":
+            # About the same distance as 2 degrees of latitude.
+            epsilon = 220.0
+        else:
+            epsilon = 2.0
+    elif epsilon == "auto":
+        epsilon = suggest_epsilon(get_k_distances(eq_data.to_array(), min_pts, metric))
+    if engine == "python":
+        cluster_count = dbscan(eq_data, epsilon, min_pts, metric)
+    elif engine == "numpy":
+        labels = dbscan_numpy(eq_data.to_array(), epsilon, min_pts, metric)
+        # Copy the labels back so the rest of the steps work the same way.
+        eq_data.set_labels(labels)
+        cluster_count = int(labels.max()) + 1 if len(labels) > 0 else 0
+    else:
+        raise ValueError("Unknown dbscan engine: %s" % engine)
+    return eq_data, cluster_count
+
+def load_background(filename):
+    """
+    Returns the decoded background image in filename. The decoded pixels
+    are cached in a .npy file next to the image, so later runs map the
+    cache instead of decoding the image again. The cache is rebuilt
+    whenever the image is newer than it.
+    """
+    cache_name = filename + ".npy"
+    try:
+        if os.path.getmtime(cache_name) >= os.path.getmtime(filename):
+            return np.load(cache_name, mmap_mode="r")
+    except (OSError, ValueError):
+        pass
+    img = np.asarray(imageio.imread(filename))
+    write_cache_file(cache_name, lambda file: np.save(file, img))
+    return img
+
+def plot_earthquakes(filename, engine="python", metric="euclidean", epsilon=None, min_pts=4):
     """
     Creates clusters of earthquakes from the data contained in filename and
     displays them on a world map.
+    engine, metric, epsilon and min_pts are passed on to cluster_earthquakes.
     """
 
     print("Creating and visualizing clusters from file: %s" % filename)
 
-    # To Do: Use the functions you wrote above to complete the following 5
-    # steps. Delete this comment when you are done.
-
-    # Step 1: Gets a list of all of the earthquake locations.
-    # Step 2: Initializes the data dictionary.
-    # Step 3: Use dbscan to create clusters.
     # Step 4: Get the list of created clusters.
     # Step 5: Plot the clusters.
-    epsilon = 2.0
-    min_pts = 4
-    eq_list = get_eq_locations(filename)
-    eq_dict = initialize_database(eq_list)
-    cluster_count = dbscan(eq_dict, epsilon, min_pts)
-    clusters = get_clusters(eq_dict, cluster_count)
-    plot_clusters(clusters)
+    eq_data, cluster_count = cluster_earthquakes(filename, engine, metric, epsilon, min_pts)
+    clusters = get_clusters(eq_data, cluster_count)
+    plot_clusters(clusters, eq_data)
 
     # Set the image background to be a world-map
-    # Don't change anything after this point.
-    img = imageio.imread("world-map-full.jpg")
+    img = load_background("world-map-full.jpg")
     pp.imshow(img, zorder=0, extent=[-180, 180, -90, 90])
     pp.axis('off')
     pp.show()
 
+def export_tiles(image, tile_dir, max_zoom, tile_size=256):
+    """
+    Cuts the image of the whole map into square tiles of tile_size pixels,
+    saved as tile_dir/zoom/x/y.png. The image must be tile_size * 2 ** max_zoom
+    pixels high and twice as wide. Each lower zoom level halves the image.
+    """
+    level = np.asarray(image)
+    for zoom in range(max_zoom, -1, -1):
+        for x in range(level.shape[1] // tile_size):
+            folder = os.path.join(tile_dir, str(zoom), str(x))
+            os.makedirs(folder, exist_ok=True)
+            for y in range(level.shape[0] // tile_size):
+                tile = level[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size]
+                imageio.imwrite(os.path.join(folder, "%d.png" % y), tile)
+        # Average each 2x2 block of pixels to get the next level down.
+        height, width = level.shape[0] // 2, level.shape[1] // 2
+        blocks = level[:height * 2, :width * 2].reshape(height, 2, width, 2, -1)
+        level = blocks.mean(axis=(1, 3)).round().astype(np.uint8)
+
+def render_earthquakes(filename, output, engine="python", metric="euclidean",
+                       background="world-map-full.jpg", tile_dir=None, max_zoom=2, tile_size=256,
+                       epsilon=None, min_pts=4, use_cache=True):
+    """
+    Creates clusters of earthquakes from the data contained in filename and
+    saves the world map as the PNG file output, without needing a display.
+    If tile_dir is given the map is also cut into a pyramid of zoom tiles
+    (see export_tiles). The map is tile_size * 2 ** max_zoom pixels high.
+    background is the world map image, or None for no background.
+    epsilon, min_pts and use_cache are passed on to cluster_earthquakes.
+    Returns the number of clusters.
+    """
+    eq_data, cluster_count = cluster_earthquakes(filename, engine, metric, epsilon, min_pts, use_cache)
+    clusters = get_clusters(eq_data, cluster_count)
+
+    # Draw on a figure with its own Agg canvas instead of pyplot,
+    # so nothing tries to open a window.
+    height = tile_size * 2 ** max_zoom
+    figure = Figure(figsize=(2 * height / 100, height / 100), dpi=100)
+    canvas = FigureCanvasAgg(figure)
+    axes = figure.add_axes([0, 0, 1, 1])
+    plot_clusters(clusters, eq_data, axes)
+    if background is not None:
+        axes.imshow(load_background(background), zorder=0, extent=[-180, 180, -90, 90])
+    axes.set_xlim(-180, 180)
+    axes.set_ylim(-90, 90)
+    axes.axis('off')
+    canvas.draw()
+    image = np.asarray(canvas.buffer_rgba())
+    imageio.imwrite(output, image)
+    if tile_dir is not None:
+        export_tiles(image, tile_dir, max_zoom, tile_size)
+    return cluster_count
+
+def find_csv_files(paths):
+    """
+    Returns the CSV files named in paths, where each directory in paths
+    stands for all of the CSV files in it.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.csv"))))
+        else:
+            files.append(path)
+    return files
+
+def get_output_names(filenames):
+    """
+    Returns the name of the outputs of each file in filenames: the file name
+    without its extension, with as many of the folders above it in front
+    (joined with "_") as it takes to tell apart files with the same name.
+    Files that still share a name (like a_b.csv and a/b.csv) are left sharing it.
+    """
+    parts = [[part for part in os.path.abspath(os.path.splitext(filename)[0]).split(os.sep) if part]
+             for filename in filenames]
+    depths = [1] * len(parts)
+    while True:
+        names = ["_".join(part[-depth:]) for part, depth in zip(parts, depths)]
+        counts = {}
+        for name in names:
+            counts[name] = counts.get(name, 0) + 1
+        longer = [i for i, name in enumerate(names) if counts[name] > 1 and depths[i] < len(parts[i])]
+        if not longer:
+            return names
+        for i in longer:
+            depths[i] += 1
+
+def main(argv):
+    """
+    Command line entry point that renders cluster maps for CSV files
+    (or directories of them) without a display, several files at a time.
+    """
+    parser = argparse.ArgumentParser(description="Render earthquake cluster maps to PNG files.")
+    parser.add_argument("inputs", nargs="+", help="CSV files or directories of CSV files")
+    parser.add_argument("--output-dir", default=".", help="where to write the maps")
+    parser.add_argument("--engine", choices=["python", "numpy"], default="numpy")
+    parser.add_argument("--metric", choices=["euclidean", "haversine"], default="euclidean")
+    parser.add_argument("--background", default="world-map-full.jpg", help="world map image")
+    parser.add_argument("--no-background", action="store_true", help="draw the clusters only")
+    parser.add_argument("--tiles", action="store_true", help="also write a pyramid of zoom tiles")
+    parser.add_argument("--max-zoom", type=int, default=2, help="deepest tile zoom level")
+    parser.add_argument("--processes", type=int, default=None, help="files rendered at once")
+    parser.add_argument("--epsilon", default=None, help='cluster distance, or "auto" to pick it per file')
+    parser.add_argument("--min-pts", type=int, default=4, help="neighbours needed for a core point")
+    parser.add_argument("--no-cache", action="store_true", help="do not cache the parsed CSV files")
+    args = parser.parse_args(argv)
+    if args.epsilon not in (None, "auto"):
+        args.epsilon = float(args.epsilon)
+
+    # A file given twice is only rendered once, and files with the same
+    # name in different folders must not write over each other's maps.
+    filenames = []
+    seen = set()
+    for filename in find_csv_files(args.inputs):
+        if os.path.realpath(filename) not in seen:
+            seen.add(os.path.realpath(filename))
+            filenames.append(filename)
+    names = get_output_names(filenames)
+    sharing = {}
+    for filename, name in zip(filenames, names):
+        sharing.setdefault(name, []).append(filename)
+    for name, files in sharing.items():
+        if len(files) > 1:
+            parser.error("these files would all be written to %s.png: %s" % (name, ", ".join(files)))
+
+    background = None if args.no_background else args.background
+    os.makedirs(args.output_dir, exist_ok=True)
+    with concurrent.futures.ProcessPoolExecutor(args.processes) as pool:
+        jobs = []
+        for filename, name in zip(filenames, names):
+            output = os.path.join(args.output_dir, name + ".png")
+            tile_dir = os.path.join(args.output_dir, name) if args.tiles else None
+            jobs.append((filename, output, pool.submit(
+                render_earthquakes, filename, output, args.engine, args.metric,
+                background, tile_dir, args.max_zoom, 256, args.epsilon, args.min_pts,
+                not args.no_cache)))
+        for filename, output, job in jobs:
+            print("%s: %d clusters -> %s" % (filename, job.result(), output))
+
 
 if __name__ == "__main__":
-    # Choose the input file
-    choice = input("Enter 1 (for eq_day.csv) or 2 (for eq_week.csv): ")
-
-    # Create the clusters and plot the data.
-    if choice == "1":
-        plot_earthquakes("eq_day.csv")
-    elif choice == "2":
-        plot_earthquakes("eq_week.csv")
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
     else:
-        print("Invalid choice")
\ No newline at end of file
+        # Choose the input file
+        choice = input("Enter 1 (for eq_day.csv) or 2 (for eq_week.csv): ")
+
+        # Create the clusters and plot the data.
+        if choice == "1":
+            plot_earthquakes("eq_day.csv")
+        elif choice == "2":
+            plot_earthquakes("eq_week.csv")
+        else:
+            print("Invalid choice")
\ No newline at end of file
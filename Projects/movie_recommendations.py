@@ -5,8 +5,17 @@ Author: Eric Pan and Rayan Pal
 Description: Predicts movie ratings for users.
 """
 
+import os
 import math
 import csv
+import heapq
+import itertools
+import multiprocessing
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+import numpy as np
+from scipy.sparse import csr_matrix, diags
 from scipy.stats import pearsonr
 
 class BadInputError(Exception):
@@ -15,25 +24,50 @@ class BadInputError(Exception):
 
 class Movie_Recommendations:
 
-    def __init__(self, movie_filename, training_ratings_filename):
+    def __init__(self, movie_filename, training_ratings_filename, cache_size=100000, neighbourhood_size=None):
         """
         Initializes the Movie_Recommendations object from 
         the files containing movie names and training ratings.  
+        cache_size is the most similarities kept in self.similarity_cache
+        (None for no limit).
+        neighbourhood_size is the number of most similar movies of each
+        movie that predictions use (None to use every movie).
         The following instance variables should be initialized:
         self.movie_dict - A dictionary that maps a movie id to
                a movie objects (objects the class Movie)
-        self.user_dict - A dictionary that maps user id's to a 
+        self.rating_store - A RatingStore that holds all the ratings.
+        self.user_dict - Maps user id's to a 
                a dictionary that maps a movie id to the rating
-               that the user gave to the movie.    
+               that the user gave to the movie. This is the
+               rating store itself, so it is read-only; ratings
+               are added with add_ratings.
+        self.movie_index - A dictionary that maps a movie id to its
+               row in self.similarity_matrix, or None until
+               build_similarities is called.
+        self.movie_ids - The list of movie ids in the order of
+               their rows, or None until build_similarities is called.
+        self.similarity_matrix - A sparse matrix of the similarities
+               between movies, or None until build_similarities is called.
+        self.user_index - A dictionary that maps a user id to its
+               row in self.rating_matrix, or None until
+               build_similarities is called.
+        self.rating_matrix - A sparse user by movie matrix of the
+               training ratings, or None until build_similarities is called.
+        self.similarity_cache - A SimilarityCache shared by all the movies
+               for the similarities computed by predict_rating.
+        self.neighbourhood_size - The neighbourhood_size given.
+        self.neighbour_matrix - The rows of self.similarity_matrix cut
+               down to the neighbourhood_size most similar movies, or
+               None if there is no neighbourhood size or until
+               build_similarities is called.
+        self.reverse_neighbours - The transpose of self.neighbour_matrix,
+               so row i lists the movies that have movie i as a neighbour.
         """
 
         #Creates a movie dictionary.
         self.movie_dict = dict()
-        
-        #Creates a user dictionary.
-        self.user_dict = dict()
 
-        #Reads movie file and assigns user ID to the key of user_dict. 
+        #Reads movie file and assigns movie ID to the key of movie_dict. 
         f = open(movie_filename)
         csv_reader = csv.reader(f, delimiter = ',', quotechar = '"')
         #The value of the key is the movie object and this iteration assigns the movie ID and title to object.
@@ -41,19 +75,262 @@ class Movie_Recommendations:
             movie = Movie(int(line[0]), line[1])
             self.movie_dict[int(line[0])] = movie
         
-        #Reads movie rating file and assigns user ID to key in user dictionary. 
-        g = open(training_ratings_filename)
-        user_reader = g.readlines()
-        #Value is a dictionary containing the key as the movie ID and rating for that particular movie for a user.
-        for line in user_reader:
+        #Reads movie rating file into columns of user IDs, movie IDs and ratings.
+        rating_users = array('i')
+        rating_movies = array('i')
+        ratings = array('f')
+        for line in open(training_ratings_filename):
             spline = line.split(',')
-            if (int(spline[0]) in self.user_dict):
-                self.user_dict[int(spline[0])][int(spline[1])] = (float(spline[2]))
-            else:
-                self.user_dict[int(spline[0])] = dict()
-                self.user_dict[int(spline[0])][int(spline[1])] = (float(spline[2]))
-            #Adds user to the users instance variable which contains a list of users that have watched a particular movie.
-            self.movie_dict[int(spline[1])].users.append(int(spline[0]))
+            rating_users.append(int(spline[0]))
+            rating_movies.append(int(spline[1]))
+            ratings.append(float(spline[2]))
+        self.rating_store = RatingStore.from_ratings(list(self.movie_dict), rating_users, rating_movies, ratings)
+        self.user_dict = self.rating_store
+        #Each movie reads the users who rated it from the rating store.
+        for movie in self.movie_dict.values():
+            movie.rating_store = self.rating_store
+            movie.row = self.rating_store.movie_index[movie.id]
+
+        #The similarity matrix is only made when build_similarities is called.
+        self.movie_index = None
+        self.movie_ids = None
+        self.similarity_matrix = None
+        self.user_index = None
+        self.rating_matrix = None
+        self.similarity_cache = SimilarityCache(cache_size)
+        self.neighbourhood_size = neighbourhood_size
+        self.neighbour_matrix = None
+        self.reverse_neighbours = None
+
+    def save(self, folder):
+        """
+        Saves a snapshot of the object in folder (made if needed) as .npy
+        files that load can memory-map: the movie titles, the arrays of
+        the rating store, and the similarity matrix if build_similarities
+        has been called.
+        """
+
+        os.makedirs(folder, exist_ok=True)
+        self.rating_store.save(folder)
+        #The titles in the order of the movie rows, joined into one block of UTF-8 text.
+        titles = [self.movie_dict[movie_id].title.encode("utf-8") for movie_id in self.rating_store.movie_ids.tolist()]
+        save_array(folder, "titles", np.frombuffer(b"".join(titles), dtype=np.uint8))
+        save_array(folder, "title_offsets", np.cumsum([0] + [len(title) for title in titles]))
+
+        #The similarity matrix, if there is one, is saved as its CSR arrays.
+        #Removing a file leaves any memory-mapped copy of it readable.
+        for name in ["similarity_data", "similarity_indices", "similarity_indptr"]:
+            path = os.path.join(folder, name + ".npy")
+            if os.path.exists(path):
+                os.remove(path)
+        if self.similarity_matrix is not None:
+            save_array(folder, "similarity_data", self.similarity_matrix.data)
+            save_array(folder, "similarity_indices", self.similarity_matrix.indices)
+            save_array(folder, "similarity_indptr", self.similarity_matrix.indptr)
+
+    @classmethod
+    def load(cls, folder, cache_size=100000, neighbourhood_size=None):
+        """
+        Returns a Movie_Recommendations object made from a snapshot saved
+        in folder by save, without reading the CSV files. The arrays are
+        memory-mapped, and the similarity matrix is ready if one was saved.
+        cache_size and neighbourhood_size are the same as for the constructor.
+        """
+
+        def load_array(name):
+            return np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+
+        movie_recs = cls.__new__(cls)
+        movie_recs.rating_store = RatingStore.load(folder)
+        movie_recs.user_dict = movie_recs.rating_store
+        titles = load_array("titles").tobytes()
+        title_offsets = load_array("title_offsets").tolist()
+        movie_recs.movie_dict = dict()
+        for row, movie_id in enumerate(movie_recs.rating_store.movie_ids.tolist()):
+            movie = Movie(movie_id, titles[title_offsets[row]:title_offsets[row + 1]].decode("utf-8"))
+            movie.rating_store = movie_recs.rating_store
+            movie.row = row
+            movie_recs.movie_dict[movie_id] = movie
+
+        movie_recs.movie_index = None
+        movie_recs.movie_ids = None
+        movie_recs.similarity_matrix = None
+        movie_recs.user_index = None
+        movie_recs.rating_matrix = None
+        movie_recs.similarity_cache = SimilarityCache(cache_size)
+        movie_recs.neighbourhood_size = neighbourhood_size
+        movie_recs.neighbour_matrix = None
+        movie_recs.reverse_neighbours = None
+        if os.path.exists(os.path.join(folder, "similarity_data.npy")):
+            #The rows of the saved matrix are the rows of the rating store, like build_similarities.
+            movie_recs.movie_ids = movie_recs.rating_store.movie_ids.tolist()
+            movie_recs.movie_index = movie_recs.rating_store.movie_index
+            movie_recs.user_index = movie_recs.rating_store.user_index
+            movie_recs.rating_matrix = movie_recs.rating_store.to_matrix()
+            movie_recs.similarity_matrix = csr_matrix((load_array("similarity_data"), load_array("similarity_indices"),
+                                                       load_array("similarity_indptr")),
+                                                      shape=(len(movie_recs.movie_ids), len(movie_recs.movie_ids)))
+            movie_recs.build_neighbours()
+        return movie_recs
+
+    def add_ratings(self, ratings):
+        """
+        Adds ratings, a list of (user id, movie id, rating) tuples, to the
+        database without reading the files again. A rating for a movie the
+        user already rated replaces the old one, and new users are added.
+        A new rating by a user only changes the similarities between that
+        movie and the other movies the user rated, so only those are
+        recomputed in self.similarity_matrix and dropped from the caches,
+        and only the neighbours of those movies are chosen again.
+        Afterwards the similarities and predictions are exactly the same as
+        building from a file with all the ratings, however they are batched.
+        If a movie_id is not in the database, then BadInputError is raised
+        and nothing is added.
+        """
+
+        ratings = [(int(user_id), int(movie_id), float(rating)) for user_id, movie_id, rating in ratings]
+        if any(movie_id not in self.movie_dict for user_id, movie_id, rating in ratings):
+            raise BadInputError
+
+        #Adds the ratings and finds every pair of movies whose similarity changes.
+        self.rating_store.add(ratings)
+        rated = {user_id: self.user_dict[user_id] for user_id, movie_id, rating in ratings}
+        changed = set()
+        for user_id, movie_id, rating in ratings:
+            for other_movie_id in rated[user_id]:
+                if other_movie_id != movie_id:
+                    changed.add((min(movie_id, other_movie_id), max(movie_id, other_movie_id)))
+        for movie_id, other_movie_id in changed:
+            self.movie_dict[movie_id].similarities.pop(other_movie_id, None)
+            self.movie_dict[other_movie_id].similarities.pop(movie_id, None)
+            self.similarity_cache.discard(movie_id, other_movie_id)
+
+        if self.similarity_matrix is None:
+            return
+        #Makes the rating matrix again from the store, the same way build_similarities
+        #does, so ratings of 0 are kept as entries. Adding the differences to the old
+        #matrix would drop them, and copies the whole matrix just the same.
+        self.rating_matrix = self.rating_store.to_matrix()
+        #Updates the similarities by adding the differences from the old values.
+        if len(changed) > 0:
+            pairs = list(changed)
+            rows = np.array([self.movie_index[pair[0]] for pair in pairs], dtype=np.int64)
+            cols = np.array([self.movie_index[pair[1]] for pair in pairs], dtype=np.int64)
+            new = np.array([self.movie_dict[a].compute_similarity(b, self.movie_dict, self.user_dict) for a, b in pairs])
+            difference = new - np.asarray(self.similarity_matrix[rows, cols]).ravel()
+            self.similarity_matrix = self.similarity_matrix + csr_matrix(
+                (np.concatenate([difference, difference]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                shape=self.similarity_matrix.shape)
+            self.build_neighbours(np.unique(np.concatenate([rows, cols])))
+
+    def build_similarities(self):
+        """
+        Computes the similarity of every pair of movies that have a user in
+        common, all at once from the ratings, and stores them in
+        self.similarity_matrix (a CSR matrix indexed through self.movie_index)
+        so that predict_rating only has to look them up.
+        The similarities are the same as the ones from Movie.compute_similarity.
+        Pairs with no users in common are left out, since their similarity is 0.
+        """
+
+        #Uses the user and movie rows of the rating store and lists every rating.
+        store = self.rating_store
+        movie_ids = store.movie_ids.tolist()
+        self.movie_ids = movie_ids
+        self.movie_index = store.movie_index
+        self.user_index = store.user_index
+        users = np.repeat(np.arange(len(store.user_ids), dtype=np.int32), np.diff(store.user_offsets))
+        movies = np.asarray(store.user_movies)
+        ratings = store.user_ratings.astype(float)
+        shape = (len(store.user_ids), len(movie_ids))
+
+        def rated_at_least(level):
+            #Matrix with a 1 wherever a user gave a movie a rating of at least level.
+            mask = ratings >= level
+            return csr_matrix((np.ones(np.count_nonzero(mask)), (users[mask], movies[mask])), shape=shape)
+
+        #The number of users who rated both movies.
+        rated = csr_matrix((np.ones(len(ratings)), (users, movies)), shape=shape)
+        counts = (rated.T @ rated).tocoo()
+        keys = counts.row.astype(np.int64) * len(movie_ids) + counts.col
+        order = np.argsort(keys)
+        keys = keys[order]
+
+        def values_at_counts(matrix):
+            #Lines the entries of matrix up with the (sorted) entries of counts.
+            matrix = matrix.tocoo()
+            values = np.zeros(len(keys))
+            values[np.searchsorted(keys, matrix.row.astype(np.int64) * len(movie_ids) + matrix.col)] = matrix.data
+            return values
+
+        #Over the common users |a - b| = a + b - 2 * min(a, b). The sum of the
+        #minimums is split into one count for each step up the rating scale.
+        self.rating_matrix = csr_matrix((ratings, (users, movies)), shape=shape)
+        sums = self.rating_matrix.T @ rated
+        totals = values_at_counts(sums) + values_at_counts(sums.T)
+        levels = np.unique(ratings)
+        minimums = np.zeros(len(keys))
+        if len(levels) > 0:
+            minimums += levels[0] * counts.data[order]
+        for low, high in zip(levels[:-1], levels[1:]):
+            above = rated_at_least(high)
+            minimums += (high - low) * values_at_counts(above.T @ above)
+        differences = totals - 2 * minimums
+
+        #Same formula as compute_similarity, leaving out each movie with itself.
+        rows = counts.row[order]
+        cols = counts.col[order]
+        similarities = 1 - (differences / counts.data[order]) / 4.5
+        other = rows != cols
+        self.similarity_matrix = csr_matrix((similarities[other], (rows[other], cols[other])),
+                                            shape=(len(movie_ids), len(movie_ids)))
+        self.build_neighbours()
+
+    def build_neighbours(self, movie_rows=None):
+        """
+        Keeps the self.neighbourhood_size most similar movies of each movie
+        (each row of self.similarity_matrix) in self.neighbour_matrix, and
+        its transpose in self.reverse_neighbours. Only the rows in the array
+        movie_rows are chosen again if it is given. Does nothing if there
+        is no neighbourhood size.
+        """
+
+        if self.neighbourhood_size is None:
+            return
+        if movie_rows is None or self.neighbour_matrix is None:
+            self.neighbour_matrix = get_top_k_rows(self.similarity_matrix, self.neighbourhood_size)
+        else:
+            #Clears the rows and adds them back from the new similarities.
+            size = self.similarity_matrix.shape[0]
+            kept = np.ones(size)
+            kept[movie_rows] = 0
+            chosen = get_top_k_rows(self.similarity_matrix[movie_rows], self.neighbourhood_size)
+            placed = csr_matrix((np.ones(len(movie_rows)), (movie_rows, np.arange(len(movie_rows)))),
+                                shape=(size, len(movie_rows)))
+            self.neighbour_matrix = (diags(kept) @ self.neighbour_matrix + placed @ chosen).tocsr()
+        self.reverse_neighbours = self.neighbour_matrix.T.tocsr()
+
+    def get_prediction_matrix(self):
+        """
+        Returns the matrix whose row for a movie has the similarities that
+        predictions of it use: self.neighbour_matrix if there is a
+        neighbourhood size, and self.similarity_matrix if not.
+        """
+        if self.neighbourhood_size is not None:
+            return self.neighbour_matrix
+        return self.similarity_matrix
+
+    def get_similarities(self, movie_id):
+        """
+        Returns a dictionary that maps the self.movie_index row of a movie
+        to its similarity with movie_id, read from the matrix made by
+        build_similarities (only the neighbours of movie_id if there is a
+        neighbourhood size). Movies that are missing have a similarity of 0.
+        """
+        matrix = self.get_prediction_matrix()
+        row = self.movie_index[movie_id]
+        start, stop = matrix.indptr[row], matrix.indptr[row + 1]
+        return dict(zip(matrix.indices[start:stop].tolist(), matrix.data[start:stop].tolist()))
             
 
     def predict_rating(self, user_id, movie_id):
@@ -64,6 +341,8 @@ class Movie_Recommendations:
         that rating.
         If either user_id or movie_id is not in the database,
         then BadInputError is raised.
+        If there is a neighbourhood size, only the neighbours of movie_id
+        are used, and build_similarities is called first if it has not been.
         """
     
         total = 0
@@ -71,15 +350,34 @@ class Movie_Recommendations:
         #Checks if user ID and movie ID is valid.
         if (user_id not in self.user_dict) or (movie_id not in self.movie_dict):
             raise BadInputError
+        user_ratings = self.user_dict[user_id]
         #Returns rating if user has watched the movie.
-        elif (user_id in self.movie_dict[movie_id].users):
-            return self.user_dict[user_id][movie_id]
+        if (movie_id in user_ratings):
+            return user_ratings[movie_id]
+        elif self.neighbourhood_size is not None:
+            if self.similarity_matrix is None:
+                self.build_similarities()
+            #Only visits the neighbours of the movie, whatever the number of movies the user rated.
+            for row, similarity in self.get_similarities(movie_id).items():
+                other_movie_id = self.movie_ids[row]
+                if other_movie_id in user_ratings:
+                    total += user_ratings[other_movie_id] * similarity
+                    denominator += similarity
+            if denominator == 0:
+                return 2.5
+            return total / denominator
         else:
+            #Looks the similarities up if build_similarities has been called.
+            if self.similarity_matrix is not None:
+                similarities = self.get_similarities(movie_id)
             #Computes the similiarty for user_id if they haven't watched movie_id.
-            for other_movie_id in self.user_dict[user_id].keys():
-                similarity_num = (self.user_dict[user_id][other_movie_id]) * (self.movie_dict[other_movie_id].get_similarity(movie_id, self.movie_dict, self.user_dict))
-                total += similarity_num
-                denominator += (self.movie_dict[other_movie_id].get_similarity(movie_id, self.movie_dict, self.user_dict))
+            for other_movie_id, rating in user_ratings.items():
+                if self.similarity_matrix is not None:
+                    similarity = similarities.get(self.movie_index[other_movie_id], 0)
+                else:
+                    similarity = self.movie_dict[other_movie_id].get_similarity(movie_id, self.movie_dict, self.user_dict, self.similarity_cache)
+                total += rating * similarity
+                denominator += similarity
             if denominator == 0:
                 return 2.5
             else:
@@ -88,18 +386,101 @@ class Movie_Recommendations:
         
             
 
-    def predict_ratings(self, test_ratings_filename):
+    def predict_many(self, user_ids, movie_ids, block_size=10000):
         """
-        Returns a list of tuples, one tuple for each rating in the
-        test ratings file.
-        The tuple should contain
-        (user id, movie title, predicted rating, actual rating)
+        Returns a list of the predicted ratings that each user in user_ids
+        will give to the movie at the same position in movie_ids, the same
+        as calling predict_rating on every pair but scored block_size pairs
+        at a time with sparse matrix operations.
+        build_similarities is called first if it has not been.
+        If any user_id or movie_id is not in the database,
+        then BadInputError is raised.
+        """
+
+        if self.similarity_matrix is None:
+            self.build_similarities()
+        if any(user_id not in self.user_index for user_id in user_ids) or \
+           any(movie_id not in self.movie_index for movie_id in movie_ids):
+            raise BadInputError
+        users = np.array([self.user_index[user_id] for user_id in user_ids], dtype=np.int64)
+        movies = np.array([self.movie_index[movie_id] for movie_id in movie_ids], dtype=np.int64)
+
+        predictions = np.empty(len(users))
+        for start in range(0, len(users), block_size):
+            block_users = users[start:start + block_size]
+            block_movies = movies[start:start + block_size]
+            #Row i holds the ratings of the user and the similarities to the movie of pair i.
+            user_ratings = self.rating_matrix[block_users]
+            user_rated = user_ratings.copy()
+            user_rated.data[:] = 1
+            similarities = self.get_prediction_matrix()[block_movies]
+            totals = np.asarray(user_ratings.multiply(similarities).sum(axis=1)).ravel()
+            denominators = np.asarray(user_rated.multiply(similarities).sum(axis=1)).ravel()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                block = np.where(denominators == 0, 2.5, totals / denominators)
+            #Users who already rated the movie get their own rating back.
+            pairs = np.arange(len(block_users))
+            rated = np.asarray(user_rated[pairs, block_movies]).ravel() == 1
+            block[rated] = np.asarray(user_ratings[pairs[rated], block_movies[rated]]).ravel()
+            predictions[start:start + block_size] = block
+        return predictions.tolist()
+
+    def recommend(self, user_id, n=10):
+        """
+        Returns a list of up to n (movie id, predicted rating) tuples for
+        the movies user_id has not rated that have the highest predicted
+        ratings, best first. The predictions are the same as predict_rating.
+        Only the movies in the similarity rows (neighbour lists) of the
+        movies the user rated, or with a neighbourhood size the movies that
+        have them as neighbours, are scored; any other movie shares no users
+        with them and is left out, as are movies with a similarity of 0
+        to all of them. build_similarities is called first if it has not been.
+        If user_id is not in the database, then BadInputError is raised.
+        """
+
+        if user_id not in self.user_dict:
+            raise BadInputError
+        if self.similarity_matrix is None:
+            self.build_similarities()
+        rated = self.user_dict[user_id]
+        rows = np.array([self.movie_index[movie_id] for movie_id in rated], dtype=np.int64)
+        ratings = np.array(list(rated.values()))
+
+        #Adds up the weighted ratings of each candidate from the neighbour lists.
+        #A candidate is scored from the movies in its own neighbourhood.
+        if self.neighbourhood_size is not None:
+            neighbours = self.reverse_neighbours[rows].tocoo()
+        else:
+            neighbours = self.similarity_matrix[rows].tocoo()
+        candidates, inverse = np.unique(neighbours.col, return_inverse=True)
+        totals = np.bincount(inverse, weights=neighbours.data * ratings[neighbours.row], minlength=len(candidates))
+        denominators = np.bincount(inverse, weights=neighbours.data, minlength=len(candidates))
+        keep = (denominators > 0) & ~np.isin(candidates, rows)
+
+        #Keeps the n best with a heap instead of sorting every candidate.
+        scored = zip((totals[keep] / denominators[keep]).tolist(), candidates[keep].tolist())
+        best = heapq.nlargest(n, scored, key=lambda pair: pair[0])
+        return [(self.movie_ids[row], prediction) for prediction, row in best]
+
+    def predict_lines(self, lines, engine="python"):
+        """
+        Returns a list of (user id, movie title, predicted rating, actual rating)
+        tuples, one for each "user id,movie id,rating" line in lines.
+        engine is "python" to call predict_rating on each line, or
+        "sparse" to score all the lines at once with predict_many.
         """
 
-        #Creates a list containing tuples of user id, movie title, predicted rating, and actual rating.
-        f = open(test_ratings_filename)
-        lines = f.readlines()
         rating_list = []
+        if engine == "sparse":
+            lines = [i.split(",") for i in lines]
+            user_ids = [int(line[0]) for line in lines]
+            movie_ids = [int(line[1]) for line in lines]
+            predictions = self.predict_many(user_ids, movie_ids)
+            for user_id, movie_id, predicted, line in zip(user_ids, movie_ids, predictions, lines):
+                rating_list.append((user_id, self.movie_dict[movie_id].title, predicted, float(line[2])))
+            return rating_list
+        elif engine != "python":
+            raise ValueError("Unknown engine: %s" % engine)
         for i in lines:
             line = i.split(",")
             #creates tuple.
@@ -107,8 +488,62 @@ class Movie_Recommendations:
             #Adds tuple to list.
             rating_list.append(tuple(one_review))
         return (rating_list)
+
+    def predict_ratings(self, test_ratings_filename, engine="python", processes=1):
+        """
+        Returns a list of tuples, one tuple for each rating in the
+        test ratings file.
+        The tuple should contain
+        (user id, movie title, predicted rating, actual rating)
+        engine is "python" to call predict_rating on each line, or
+        "sparse" to score the whole file at once with predict_many.
+        If processes is not 1, the file is split into chunks that are
+        predicted in parallel by a pool of that many processes (None for
+        one per CPU), and the tuples are still in the order of the file.
+        """
+
+        if processes == 1:
+            return list(self.iter_predictions(test_ratings_filename, engine))
+        #Creates a list containing tuples of user id, movie title, predicted rating, and actual rating.
+        f = open(test_ratings_filename)
+        lines = f.readlines()
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        #The matrices are made once here so the workers share them instead of each making its own.
+        #Both engines need them with a neighbourhood size, and the sparse engine always does.
+        if (engine == "sparse" or self.neighbourhood_size is not None) and self.similarity_matrix is None:
+            self.build_similarities()
+        #A few chunks for each process so a slow chunk does not hold the others up.
+        chunk_size = max(1, -(-len(lines) // (4 * processes)))
+        tasks = [(lines[start:start + chunk_size], engine) for start in range(0, len(lines), chunk_size)]
+        pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(self,))
+        try:
+            chunks = pool.map(predict_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        return [rating for chunk in chunks for rating in chunk]
         
 
+    def iter_predictions(self, test_ratings_filename, engine="python", evaluation=None, block_size=10000):
+        """
+        Yields the same (user id, movie title, predicted rating, actual rating)
+        tuples as predict_ratings, one at a time, reading the test ratings
+        file block_size lines at a time so that only one block is in memory.
+        If evaluation (a RunningEvaluation) is given, each prediction
+        is added to it as it is yielded.
+        """
+
+        with open(test_ratings_filename) as f:
+            while True:
+                lines = list(itertools.islice(f, block_size))
+                if not lines:
+                    break
+                for rating in self.predict_lines(lines, engine):
+                    if evaluation is not None:
+                        evaluation.add(rating[2], rating[3])
+                    yield rating
+
     def correlation(self, predicted_ratings, actual_ratings):
         """
         Returns the correlation between the values in the list predicted_ratings
@@ -123,7 +558,11 @@ class Movie_Recommendations:
 class Movie: 
     """
     Represents a movie from the movie database.
+    Its ratings are not kept in the object but read from
+    the RatingStore it belongs to.
     """
+    __slots__ = ("id", "title", "similarities", "rating_store", "row")
+
     def __init__(self, id, title):
         """ 
         Constructor.
@@ -132,10 +571,10 @@ class Movie:
         variables.  (For testing purposes.)
         id: the id of the movie
         title: the title of the movie
-        users: list of the id's of the users who have
+        users: set of the id's of the users who have
             rated this movie.  Initially, this is
-            an empty list, but will be filled in
-            as the training ratings file is read.
+            an empty set; once the training ratings file
+            is read it is made from the rating store.
         similarities: a dictionary where the key is the
             id of another movie, and the value is the similarity
             between the "self" movie and the movie with that id.
@@ -148,8 +587,19 @@ class Movie:
         #Creates instance variables for the object Movie.
         self.id = id
         self.title = title
-        self.users = []
         self.similarities = dict()
+        #Set by Movie_Recommendations once the ratings are read.
+        self.rating_store = None
+        self.row = None
+
+    @property
+    def users(self):
+        """
+        Returns the set of the id's of the users who have rated this movie.
+        """
+        if self.rating_store is None:
+            return set()
+        return self.rating_store.get_users(self.row)
 
     def __str__(self):
         """
@@ -168,7 +618,7 @@ class Movie:
         #Returns string for debugging.
         return ("repr:",self.id,",",self.title,",",self.users,",",self.similarities)
 
-    def get_similarity(self, other_movie_id, movie_dict, user_dict):
+    def get_similarity(self, other_movie_id, movie_dict, user_dict, cache=None):
         """ 
         Returns the similarity between the movie that 
         called the method (self), and another movie whose
@@ -178,14 +628,23 @@ class Movie:
         method), and store it in both
         the "self" movie object, and the other_movie_id movie object.
         Then return that computed similarity.
+        If cache (a SimilarityCache) is given, the similarity is kept
+        there instead of in the movie objects.
         If other_movie_id is not valid, raise BadInputError exception.
         """
 
         #Checks if other_movie_id is valid.
         if other_movie_id not in movie_dict:
             raise BadInputError
-        if self.id in self.similarities:
-            return self.similarities[self.id]
+        #Uses the shared cache if there is one.
+        if cache is not None:
+            sim = cache.get(self.id, other_movie_id)
+            if sim is None:
+                sim = self.compute_similarity(other_movie_id, movie_dict, user_dict)
+                cache.put(self.id, other_movie_id, sim)
+            return sim
+        if other_movie_id in self.similarities:
+            return self.similarities[other_movie_id]
         #Gets similarity of movies and adds it to the similiarity instance variable dictionary.
         else:
             sim = movie_dict[self.id].compute_similarity(other_movie_id, movie_dict, user_dict)
@@ -200,35 +659,402 @@ class Movie:
         Computes and returns the similarity between the movie that 
         called the method (self), and another movie whose
         id is other_movie_id.  (Uses movie_dict and user_dict)
+        Only the users who rated both movies are visited.
         """
         
         #Computes similarity between movies.
-        averages = []
-        count = 0
-        for user in self.users:
-            #Checks if a user has watched both movies.
-            if (user in self.users and user in movie_dict[other_movie_id].users):
-                id_average = abs(user_dict[user][self.id] - user_dict[user][other_movie_id])
-                averages.append(id_average)
-                count+=1
+        users, ratings = self.rating_store.get_raters(self.row)
+        other_users, other_ratings = self.rating_store.get_raters(movie_dict[other_movie_id].row)
+        #Users who have watched both movies.
+        common, mine, others = np.intersect1d(users, other_users, assume_unique=True, return_indices=True)
+        averages = np.abs(ratings[mine].astype(float) - other_ratings[others])
+        count = len(common)
         if count>=1:
-            ave = sum(averages)
+            ave = float(averages.sum())
             diff = ave / count
             similarity = 1 - (diff)/4.5
         else:
             similarity = 0
         return similarity
 
+class SimilarityCache:
+    """
+    A cache of movie similarities shared by all the movies, keyed by the
+    pair of movie ids in either order. Once it holds maxsize similarities
+    the least recently used one is dropped, so it never grows without bound.
+    """
+    def __init__(self, maxsize=100000):
+        """
+        Constructor.
+        maxsize: the most similarities kept, or None for no limit.
+        similarities: an OrderedDict from a (smaller id, larger id) pair
+            to the similarity, with the most recently used pair last.
+        hits, misses: the number of lookups that found or did not find
+            a similarity.
+        """
+        self.maxsize = maxsize
+        self.similarities = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        """
+        Returns the number of similarities in the cache.
+        """
+        return len(self.similarities)
+
+    def get(self, movie_id, other_movie_id):
+        """
+        Returns the cached similarity between the two movies,
+        or None if it is not in the cache.
+        """
+        key = (min(movie_id, other_movie_id), max(movie_id, other_movie_id))
+        if key in self.similarities:
+            self.similarities.move_to_end(key)
+            self.hits += 1
+            return self.similarities[key]
+        self.misses += 1
+        return None
+
+    def discard(self, movie_id, other_movie_id):
+        """
+        Removes the similarity between the two movies if it is in the cache.
+        """
+        self.similarities.pop((min(movie_id, other_movie_id), max(movie_id, other_movie_id)), None)
+
+    def put(self, movie_id, other_movie_id, similarity):
+        """
+        Stores the similarity between the two movies, dropping the least
+        recently used similarity if the cache is full.
+        """
+        key = (min(movie_id, other_movie_id), max(movie_id, other_movie_id))
+        self.similarities[key] = similarity
+        self.similarities.move_to_end(key)
+        if self.maxsize is not None and len(self.similarities) > self.maxsize:
+            self.similarities.popitem(last=False)
+
+class RunningEvaluation:
+    """
+    Keeps the Pearson correlation, root mean squared error and mean
+    absolute error of predicted and actual ratings as they are added,
+    without keeping the ratings themselves. The correlation uses
+    Welford's running means and co-moments so it stays accurate over
+    millions of ratings.
+    """
+    def __init__(self):
+        """
+        Constructor.
+        count: the number of ratings added.
+        mean_predicted, mean_actual: the means of the ratings so far.
+        predicted_moment, actual_moment, co_moment: the sums of the squared
+            differences from the means and of their products.
+        squared_error, absolute_error: the sums of the errors.
+        """
+        self.count = 0
+        self.mean_predicted = 0.0
+        self.mean_actual = 0.0
+        self.predicted_moment = 0.0
+        self.actual_moment = 0.0
+        self.co_moment = 0.0
+        self.squared_error = 0.0
+        self.absolute_error = 0.0
+
+    def add(self, predicted, actual):
+        """
+        Adds one predicted rating and the actual rating.
+        """
+        self.count += 1
+        predicted_change = predicted - self.mean_predicted
+        actual_change = actual - self.mean_actual
+        self.mean_predicted += predicted_change / self.count
+        self.mean_actual += actual_change / self.count
+        self.predicted_moment += predicted_change * (predicted - self.mean_predicted)
+        self.actual_moment += actual_change * (actual - self.mean_actual)
+        self.co_moment += predicted_change * (actual - self.mean_actual)
+        self.squared_error += (predicted - actual) ** 2
+        self.absolute_error += abs(predicted - actual)
+
+    def correlation(self):
+        """
+        Returns the Pearson correlation of the ratings so far,
+        or nan if either kind of rating has not varied.
+        """
+        if self.predicted_moment <= 0 or self.actual_moment <= 0:
+            return float("nan")
+        return self.co_moment / math.sqrt(self.predicted_moment * self.actual_moment)
+
+    def rmse(self):
+        """
+        Returns the root mean squared error of the ratings so far, or nan if there are none.
+        """
+        return math.sqrt(self.squared_error / self.count) if self.count > 0 else float("nan")
+
+    def mae(self):
+        """
+        Returns the mean absolute error of the ratings so far, or nan if there are none.
+        """
+        return self.absolute_error / self.count if self.count > 0 else float("nan")
+
+class RatingStore(Mapping):
+    """
+    All the ratings, kept in compact columns. Users and movies are given
+    rows numbered from 0, and the ratings are stored twice, grouped by user
+    like a CSR matrix and grouped by movie like a CSC matrix:
+    user_movies and user_ratings hold the movie rows and ratings of user
+    row u at user_offsets[u]:user_offsets[u + 1], and movie_users and
+    movie_ratings hold the user rows and ratings of movie row m at
+    movie_offsets[m]:movie_offsets[m + 1]. Ids and rows are int32 and
+    ratings float32.
+    It is also a read-only mapping from user id to a dictionary that maps
+    a movie id to the rating, the same as the old user_dict.
+    """
+    ARRAYS = ["movie_ids", "user_ids", "user_offsets", "user_movies", "user_ratings",
+              "movie_offsets", "movie_users", "movie_ratings"]
+
+    def __init__(self, movie_ids, user_ids, user_offsets, user_movies, user_ratings,
+                 movie_offsets, movie_users, movie_ratings):
+        """
+        Constructor. Takes the arrays described above, where movie_ids and
+        user_ids are the id of each movie row (in increasing order) and of
+        each user row.
+        movie_index, user_index: dictionaries that map an id to its row.
+        """
+        self.movie_ids = movie_ids
+        self.user_ids = user_ids
+        self.user_offsets = user_offsets
+        self.user_movies = user_movies
+        self.user_ratings = user_ratings
+        self.movie_offsets = movie_offsets
+        self.movie_users = movie_users
+        self.movie_ratings = movie_ratings
+        self.movie_index = {movie_id: row for row, movie_id in enumerate(movie_ids.tolist())}
+        self.user_index = {user_id: row for row, user_id in enumerate(user_ids.tolist())}
+
+    @classmethod
+    def from_ratings(cls, movie_ids, rating_users, rating_movies, ratings):
+        """
+        Returns a RatingStore for the movies in movie_ids with the ratings
+        given as columns of user ids, movie ids and ratings. Users get rows
+        in the order they first appear, and each user's ratings stay in the
+        order given. A later rating of a movie by the same user replaces
+        the earlier one.
+        If a movie is not in movie_ids, then BadInputError is raised.
+        """
+        movie_ids = np.array(sorted(movie_ids), dtype=np.int32)
+        rating_users = np.asarray(rating_users, dtype=np.int32)
+        rating_movies = np.asarray(rating_movies, dtype=np.int32)
+        ratings = np.asarray(ratings, dtype=np.float32)
+        movies = np.searchsorted(movie_ids, rating_movies)
+        valid = movies < len(movie_ids)
+        valid[valid] = movie_ids[movies[valid]] == rating_movies[valid]
+        if not valid.all():
+            raise BadInputError
+
+        #Numbers the users in the order they first appear.
+        unique_users, first, users = np.unique(rating_users, return_index=True, return_inverse=True)
+        order = np.argsort(first, kind="stable")
+        rows = np.empty(len(order), dtype=np.int32)
+        rows[order] = np.arange(len(order))
+        users = rows[users.ravel()]
+        user_ids = unique_users[order]
+
+        #Keeps each (user, movie) pair once, where it first appears but with its last rating.
+        keys = users.astype(np.int64) * len(movie_ids) + movies
+        first = np.unique(keys, return_index=True)[1]
+        last = len(keys) - 1 - np.unique(keys[::-1], return_index=True)[1]
+        order = np.argsort(first)
+        users = users[first[order]]
+        movies = movies[first[order]].astype(np.int32)
+        ratings = ratings[last[order]]
+
+        by_user = np.argsort(users, kind="stable")
+        by_movie = np.argsort(movies, kind="stable")
+        user_offsets = np.concatenate([[0], np.cumsum(np.bincount(users, minlength=len(user_ids)))])
+        movie_offsets = np.concatenate([[0], np.cumsum(np.bincount(movies, minlength=len(movie_ids)))])
+        return cls(movie_ids, user_ids, user_offsets, movies[by_user], ratings[by_user],
+                   movie_offsets, users[by_movie], ratings[by_movie])
+
+    def save(self, folder):
+        """
+        Saves the arrays in folder as .npy files, replacing any saved
+        before without changing arrays that load memory-mapped from them.
+        """
+        for name in self.ARRAYS:
+            save_array(folder, name, getattr(self, name))
+
+    @classmethod
+    def load(cls, folder):
+        """
+        Returns the RatingStore saved in folder, with its arrays memory-mapped.
+        """
+        return cls(*[np.load(os.path.join(folder, name + ".npy"), mmap_mode="r") for name in cls.ARRAYS])
+
+    def __getitem__(self, user_id):
+        """
+        Returns a dictionary that maps a movie id to the rating
+        that user_id gave to the movie.
+        """
+        row = self.user_index[user_id]
+        start, stop = self.user_offsets[row], self.user_offsets[row + 1]
+        return dict(zip(self.movie_ids[self.user_movies[start:stop]].tolist(), self.user_ratings[start:stop].tolist()))
+
+    def __iter__(self):
+        """
+        Iterates over the user ids in the order of their rows.
+        """
+        return iter(self.user_ids.tolist())
+
+    def __len__(self):
+        """
+        Returns the number of users.
+        """
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        """
+        Returns True if user_id has rated a movie.
+        """
+        return user_id in self.user_index
+
+    def get_raters(self, movie_row):
+        """
+        Returns the arrays of the user rows and the ratings of the movie
+        in row movie_row.
+        """
+        start, stop = self.movie_offsets[movie_row], self.movie_offsets[movie_row + 1]
+        return self.movie_users[start:stop], self.movie_ratings[start:stop]
+
+    def get_users(self, movie_row):
+        """
+        Returns the set of the ids of the users who rated the movie in row movie_row.
+        """
+        return set(self.user_ids[self.get_raters(movie_row)[0]].tolist())
+
+    def to_matrix(self):
+        """
+        Returns the ratings as a CSR user by movie matrix with sorted indices.
+        """
+        matrix = csr_matrix((self.user_ratings.astype(float), np.array(self.user_movies), np.array(self.user_offsets)),
+                            shape=(len(self.user_ids), len(self.movie_ids)))
+        matrix.sort_indices()
+        return matrix
+
+    def add(self, ratings):
+        """
+        Adds ratings, a list of (user id, movie id, rating) tuples for
+        movies in the store. A rating for a movie the user already rated
+        replaces the old one, and new users get the next rows. New ratings
+        go after the user's other ratings. The arrays are replaced, not
+        changed, so a memory-mapped store can be added to.
+        """
+        latest = dict()
+        for user_id, movie_id, rating in ratings:
+            latest[(user_id, movie_id)] = rating
+        new_users = []
+        for user_id, movie_id in latest:
+            if user_id not in self.user_index:
+                self.user_index[user_id] = len(self.user_index)
+                new_users.append(user_id)
+        user_ids = np.concatenate([self.user_ids, np.array(new_users, dtype=np.int32)])
+        user_offsets = np.concatenate([self.user_offsets, np.full(len(new_users), self.user_offsets[-1])])
+        user_ratings = np.array(self.user_ratings)
+        movie_ratings = np.array(self.movie_ratings)
+
+        #Replaces the ratings that are already there and lists the rest.
+        users = []
+        movies = []
+        values = []
+        for (user_id, movie_id), rating in latest.items():
+            user_row = self.user_index[user_id]
+            movie_row = self.movie_index[movie_id]
+            start, stop = user_offsets[user_row], user_offsets[user_row + 1]
+            found = np.flatnonzero(self.user_movies[start:stop] == movie_row)
+            if len(found) > 0:
+                user_ratings[start + found[0]] = rating
+                start, stop = self.movie_offsets[movie_row], self.movie_offsets[movie_row + 1]
+                movie_ratings[start + np.flatnonzero(self.movie_users[start:stop] == user_row)[0]] = rating
+            else:
+                users.append(user_row)
+                movies.append(movie_row)
+                values.append(rating)
+
+        #Inserts the new ratings at the end of each user's and each movie's ratings.
+        #Rows with no ratings yet share an insert position, and np.insert keeps
+        #values at the same position in the order given, so the new ratings are
+        #put in row order first (keeping the order given within each row).
+        users = np.array(users, dtype=np.int32)
+        movies = np.array(movies, dtype=np.int32)
+        values = np.array(values, dtype=np.float32)
+        by_user = np.argsort(users, kind="stable")
+        self.user_movies = np.insert(self.user_movies, user_offsets[users[by_user] + 1], movies[by_user])
+        self.user_ratings = np.insert(user_ratings, user_offsets[users[by_user] + 1], values[by_user])
+        by_movie = np.argsort(movies, kind="stable")
+        self.movie_users = np.insert(self.movie_users, self.movie_offsets[movies[by_movie] + 1], users[by_movie])
+        self.movie_ratings = np.insert(movie_ratings, self.movie_offsets[movies[by_movie] + 1], values[by_movie])
+        self.user_offsets = user_offsets + np.concatenate([[0], np.cumsum(np.bincount(users, minlength=len(user_ids)))])
+        self.movie_offsets = self.movie_offsets + np.concatenate(
+            [[0], np.cumsum(np.bincount(movies, minlength=len(self.movie_ids)))])
+        self.user_ids = user_ids
+
+def save_array(folder, name, array):
+    """
+    Saves array in folder as name.npy. It is written to a temporary file
+    that then replaces the old one, so arrays that load memory-mapped from
+    the old file keep their data, even when saving over the folder they
+    were loaded from.
+    """
+    path = os.path.join(folder, name + ".npy")
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(temp_path, "wb") as file:
+            np.save(file, array)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def get_top_k_rows(matrix, k):
+    """
+    Returns a CSR matrix with only the k largest values of each row of
+    the CSR matrix matrix, taking the lower column on a tie.
+    """
+    matrix = csr_matrix(matrix)
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    #Sorts each row from the largest value down and keeps the first k.
+    order = np.lexsort((matrix.indices, -matrix.data, rows))
+    rank = np.arange(len(order)) - matrix.indptr[rows[order]]
+    keep = order[rank < k]
+    return csr_matrix((matrix.data[keep], (rows[keep], matrix.indices[keep])), shape=matrix.shape)
+
+#The Movie_Recommendations object used by a worker process of predict_ratings.
+worker_recommendations = None
+
+def init_worker(movie_recs):
+    """
+    Keeps movie_recs for the predict_chunk calls of a worker process.
+    """
+    global worker_recommendations
+    worker_recommendations = movie_recs
+
+def predict_chunk(task):
+    """
+    Predicts the (lines, engine) task with the worker's Movie_Recommendations
+    and returns the list of tuples from predict_lines.
+    """
+    lines, engine = task
+    return worker_recommendations.predict_lines(lines, engine)
+
 if __name__ == "__main__":
     # Create movie recommendations object.
     movie_recs = Movie_Recommendations("movies.csv", "training_ratings.csv")
+    movie_recs.build_similarities()
 
-    # Predict ratings for user/movie combinations
-    rating_predictions = movie_recs.predict_ratings("test_ratings.csv")
+    # Predict ratings for user/movie combinations, printing them as they are made
+    evaluation = RunningEvaluation()
     print("Rating predictions: ")
-    for prediction in rating_predictions:
+    for prediction in movie_recs.iter_predictions("test_ratings.csv", engine="sparse", evaluation=evaluation):
         print(prediction)
-    predicted = [rating[2] for rating in rating_predictions]
-    actual = [rating[3] for rating in rating_predictions]
-    correlation = movie_recs.correlation(predicted, actual)
-    print(f"Correlation: {correlation}")    
\ No newline at end of file
+    print(f"Correlation: {evaluation.correlation()}")
+    print(f"RMSE: {evaluation.rmse()}")
+    print(f"MAE: {evaluation.mae()}")    
@@ -0,0 +1,246 @@
+"""
+Module: movie_service
+
+An asyncio service that loads a Movie_Recommendations model once and
+answers prediction requests from many clients at the same time.
+
+Clients connect over TCP and send one JSON object per line. Each request
+gets one JSON line back, with the same "id" if the request had one:
+    {"op": "predict", "user": 1, "movie": 3}            -> {"rating": 3.7}
+    {"op": "predict_batch", "pairs": [[1, 3], [2, 6]]}  -> {"ratings": [3.7, 2.5]}
+    {"op": "recommend", "user": 1, "n": 10}             -> {"movies": [[6, 4.9], ...]}
+    {"op": "stats"}                                     -> latency percentiles
+Requests on one connection are answered as they finish, not in order.
+Single predictions that arrive close together are scored together with
+one predict_many call.
+
+Example:
+    python movie_service.py --movies movies.csv --ratings training_ratings.csv --port 8765
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import concurrent.futures
+from collections import deque
+import numpy as np
+import movie_recommendations as mr
+
+class PredictionService:
+    """
+    Answers requests with a loaded Movie_Recommendations. Single predictions
+    are queued and scored in batches of up to max_batch pairs, waiting
+    max_delay seconds for a batch to fill. The model is only used from one
+    worker thread, so the event loop keeps reading requests while it scores.
+    """
+    def __init__(self, movie_recs, max_batch=1024, max_delay=0.002, window=10000):
+        """
+        Constructor.
+        movie_recs: the Movie_Recommendations, with its similarities built.
+        max_batch, max_delay: the most predictions scored together, and
+            the seconds to wait for more before scoring a batch.
+        queue: the (user id, movie id, future) predictions waiting to be scored.
+        latencies: a dictionary that maps each op to a deque of the seconds
+            its last window requests took.
+        batch_sizes: a deque of the sizes of the last window batches.
+        """
+        self.movie_recs = movie_recs
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.window = window
+        self.queue = asyncio.Queue()
+        self.latencies = dict()
+        self.batch_sizes = deque(maxlen=window)
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.tasks = set()
+
+    def check_ids(self, user_id, movie_id):
+        """
+        Raises BadInputError if user_id or movie_id is not in the database.
+        """
+        if user_id not in self.movie_recs.user_dict or movie_id not in self.movie_recs.movie_dict:
+            raise mr.BadInputError
+
+    async def run_model(self, func, *args):
+        """
+        Runs func(*args) on the model's worker thread and returns the result.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def predict(self, user_id, movie_id):
+        """
+        Returns the predicted rating of movie_id by user_id, scored in a
+        batch with the other predictions waiting at the same time.
+        """
+        self.check_ids(user_id, movie_id)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((user_id, movie_id, future))
+        return await future
+
+    async def run_batches(self):
+        """
+        Scores the queued predictions a batch at a time, forever.
+        """
+        while True:
+            batch = [await self.queue.get()]
+            # Gives other requests that are on their way a moment to join.
+            if self.queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.max_delay)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                ratings = await self.run_model(self.movie_recs.predict_many,
+                                               [item[0] for item in batch], [item[1] for item in batch])
+            except Exception as error:
+                for user_id, movie_id, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.batch_sizes.append(len(batch))
+            for (user_id, movie_id, future), rating in zip(batch, ratings):
+                if not future.done():
+                    future.set_result(rating)
+
+    async def handle_request(self, request):
+        """
+        Returns the response dictionary for the request dictionary.
+        Raises BadInputError for unknown ids and ValueError for bad requests.
+        """
+        op = request.get("op")
+        if op == "predict":
+            return {"rating": await self.predict(int(request["user"]), int(request["movie"]))}
+        elif op == "predict_batch":
+            pairs = [(int(user_id), int(movie_id)) for user_id, movie_id in request["pairs"]]
+            for user_id, movie_id in pairs:
+                self.check_ids(user_id, movie_id)
+            ratings = await self.run_model(self.movie_recs.predict_many,
+                                           [pair[0] for pair in pairs], [pair[1] for pair in pairs])
+            return {"ratings": ratings}
+        elif op == "recommend":
+            movies = await self.run_model(self.movie_recs.recommend, int(request["user"]), int(request.get("n", 10)))
+            return {"movies": [list(movie) for movie in movies]}
+        elif op == "stats":
+            return self.get_stats()
+        else:
+            raise ValueError("Unknown op: %s" % op)
+
+    async def respond(self, line, writer):
+        """
+        Answers the request in line and writes the response to writer.
+        """
+        start = time.perf_counter()
+        request = dict()
+        try:
+            request = json.loads(line)
+            response = await self.handle_request(request)
+        except mr.BadInputError:
+            response = {"error": "user ID or movie ID is not in database"}
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            response = {"error": "bad request: %s" % error}
+        except Exception as error:
+            response = {"error": "server error: %s" % error}
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        op = request.get("op") if isinstance(request, dict) else None
+        self.latencies.setdefault(str(op), deque(maxlen=self.window)).append(time.perf_counter() - start)
+        writer.write((json.dumps(response) + "\n").encode())
+        await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        """
+        Reads requests from a client until it disconnects, answering each
+        one in its own task so a slow request does not hold up the rest.
+        The connection is closed once every request read has been answered,
+        so a client that stops sending still gets all its responses.
+        """
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.create_task(self.respond(line, writer))
+                for running in (self.tasks, tasks):
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+        except ConnectionError:
+            pass
+        finally:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def get_stats(self):
+        """
+        Returns a dictionary with the number of requests of each op and
+        the 50th, 90th and 99th percentiles of their latency in milliseconds,
+        plus the number and mean size of the prediction batches.
+        """
+        stats = {"ops": dict()}
+        for op, seconds in self.latencies.items():
+            p50, p90, p99 = np.percentile(np.array(seconds) * 1000, [50, 90, 99]).tolist()
+            stats["ops"][op] = {"count": len(seconds), "p50_ms": p50, "p90_ms": p90, "p99_ms": p99}
+        sizes = list(self.batch_sizes)
+        stats["batches"] = {"count": len(sizes), "mean_size": sum(sizes) / len(sizes) if sizes else 0}
+        return stats
+
+    async def serve(self, host, port):
+        """
+        Serves clients on host and port until cancelled.
+        """
+        server = await asyncio.start_server(self.handle_client, host, port)
+        batches = asyncio.create_task(self.run_batches())
+        print("Serving on %s" % ", ".join(str(socket.getsockname()) for socket in server.sockets))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batches.cancel()
+            self.executor.shutdown(wait=False)
+
+def load_model(args):
+    """
+    Returns the Movie_Recommendations for the command line arguments, from
+    a snapshot if one was given and from the CSV files if not, with its
+    similarities built.
+    """
+    if args.snapshot is not None:
+        movie_recs = mr.Movie_Recommendations.load(args.snapshot, neighbourhood_size=args.neighbourhood_size)
+    else:
+        movie_recs = mr.Movie_Recommendations(args.movies, args.ratings, neighbourhood_size=args.neighbourhood_size)
+    if movie_recs.similarity_matrix is None:
+        movie_recs.build_similarities()
+    return movie_recs
+
+def main(argv):
+    """
+    Command line entry point that loads the model and serves it.
+    """
+    parser = argparse.ArgumentParser(description="Serve movie rating predictions.")
+    parser.add_argument("--movies", default="movies.csv")
+    parser.add_argument("--ratings", default="training_ratings.csv")
+    parser.add_argument("--snapshot", default=None, help="folder saved by Movie_Recommendations.save")
+    parser.add_argument("--neighbourhood-size", type=int, default=None)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch", type=int, default=1024, help="most predictions scored together")
+    parser.add_argument("--max-delay", type=float, default=2.0, help="milliseconds to wait for a batch to fill")
+    args = parser.parse_args(argv)
+
+    service = PredictionService(load_model(args), args.max_batch, args.max_delay / 1000)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))